@@ -11,11 +11,13 @@ import multiprocessing
 from nsm import nn_util
 from nsm.parser_module import get_parser_agent_by_name
 from nsm.parser_module.agent import PGAgent
+from nsm.parser_module.encoder import ContextEncodingCache
 from nsm.parser_module.sketch_guided_agent import SketchGuidedAgent
 from nsm.consistency_utils import ConsistencyModel, QuestionSimilarityModel
 
 import torch
 
+from nsm.execution.executor_factory import QueryCache
 from nsm.replay_buffer import ReplayBuffer
 from nsm.sketch.sketch import SketchManager
 from nsm.sketch.sketch_predictor import SketchPredictor, SketchPredictorProxy
@@ -58,6 +60,15 @@ class Actor(torch_mp.Process):
     def use_sketch_guided_replay(self):
         return self.config.get('use_sketch_guided_replay', False)
 
+    @property
+    def use_quantized_encoder(self):
+        # the encoder of table BERT proxies runs in the table BERT server
+        return (
+            self.config.get('quantize_encoder', False) and
+            self.device.type == 'cpu' and
+            not self.config.get('actor_use_table_bert_proxy', False)
+        )
+
     def run(self):
         # initialize cuda context
         self.device = torch.device(self.device)
@@ -88,6 +99,13 @@ class Actor(torch_mp.Process):
             # initialize proxy
             self.agent.encoder.bert_model.initialize(self)
 
+        if self.use_quantized_encoder:
+            self.agent.quantize_encoder()
+
+        # share context encodings of a batch among exploration, replay and on-policy sampling
+        if self.config.get('actor_use_context_encoding_cache', True):
+            self.agent.context_encoding_cache = ContextEncodingCache()
+
         # load environments
         self.load_environments(
             [
@@ -119,9 +137,15 @@ class Actor(torch_mp.Process):
         config = self.config
         epoch_id = 0
         env_dict = {env.name: env for env in self.environments}
+        # trajectories are sent to the learner without their contexts, and the context
+        # of an environment is sent along with its first trajectory
+        sent_context_env_names = set()
         sample_method = self.config['sample_method']
         method = self.config['method']
-        assert sample_method in ('sample', 'beam_search')
+        assert sample_method in ('sample', 'beam_search', 'sample_without_replacement')
+        if sample_method == 'sample_without_replacement' and self.config.get('parser', 'vanilla') == 'sketch':
+            raise ValueError('sampling without replacement is not supported by the sketch-guided parser, '
+                             'use `sample` or `beam_search` as the `sample_method`')
         assert method in ('sample', 'mapo', 'mml')
 
         work_dir = Path(self.config['work_dir'])
@@ -139,6 +163,8 @@ class Actor(torch_mp.Process):
                 epoch_start = time.time()
                 batch_iter = nn_util.batch_iter(self.environments, batch_size=self.config['batch_size'], shuffle=True)
                 for batch_id, batched_envs in enumerate(batch_iter):
+                    self.clear_context_encoding_cache()
+
                     try:
                         # print(f'[Actor {self.actor_id}] epoch {epoch_id} batch {batch_id}', file=sys.stderr)
                         # perform sampling
@@ -201,7 +227,27 @@ class Actor(torch_mp.Process):
 
                         t1 = time.time()
                         if sample_method == 'sample':
-                            explore_samples = self.agent.sample(
+                            explore_samples, sample_info = self.agent.sample(
+                                batched_envs,
+                                sample_num=config['n_explore_samples'],
+                                use_cache=config['use_cache'],
+                                constraint_sketches=constraint_sketches,
+                                return_info=True
+                            )
+
+                            if sample_info.get('steps'):
+                                print(
+                                    f'[Actor {self.actor_id}] epoch {epoch_id} batch {batch_id}, '
+                                    f'sampling took {sample_info["steps"]} steps, per step: '
+                                    f'decoder {sample_info["decoder_time"] / sample_info["steps"] * 1000:.2f}ms, '
+                                    f'compaction {sample_info["compaction_time"] / sample_info["steps"] * 1000:.2f}ms, '
+                                    f'{sample_info["decoder_row_num"] / sample_info["steps"]:.1f} rows '
+                                    f'({sample_info["active_row_num"] / sample_info["decoder_row_num"]:.1%} active); '
+                                    f'{sample_info["compaction_num"]} compactions, '
+                                    f'{sample_info["memory_allocation_num"]} memory buffers allocated', file=sys.stderr
+                                )
+                        elif sample_method == 'sample_without_replacement':
+                            explore_samples = self.agent.sample_without_replacement(
                                 batched_envs,
                                 sample_num=config['n_explore_samples'],
                                 use_cache=config['use_cache'],
@@ -219,6 +265,12 @@ class Actor(torch_mp.Process):
                             )
                         t2 = time.time()
 
+                        num_unique_explored_programs = len({
+                            (sample.trajectory.environment_name, tuple(sample.trajectory.program))
+                            for sample in explore_samples
+                        })
+                        explore_unique_programs_per_second = num_unique_explored_programs / max(t2 - t1, 1e-6)
+
                         if debug_file:
                             print('Explored programs:', file=debug_file)
                             for sample in explore_samples:
@@ -230,7 +282,10 @@ class Actor(torch_mp.Process):
                         print(
                             f'[Actor {self.actor_id}] '
                             f'epoch {epoch_id} batch {batch_id}, '
-                            f'sampled {len(explore_samples)} trajectories (took {t2 - t1}s)', file=sys.stderr
+                            f'sampled {len(explore_samples)} trajectories '
+                            f'({num_unique_explored_programs} unique programs, '
+                            f'{explore_unique_programs_per_second:.1f} unique programs/s) '
+                            f'(took {t2 - t1}s)', file=sys.stderr
                         )
 
                         # retain samples with high reward
@@ -285,6 +340,7 @@ class Actor(torch_mp.Process):
                               file=sys.stderr)
 
                         samples_info = dict()
+                        samples_info['explore_unique_programs_per_second'] = explore_unique_programs_per_second
                         if method == 'mapo':
                             train_examples = []
                             for sample in replay_samples:
@@ -351,7 +407,18 @@ class Actor(torch_mp.Process):
                             raise e
 
                     if train_examples:
-                        self.train_queue.put((train_examples, samples_info))
+                        new_contexts = dict()
+                        if self.config.get('compact_train_queue', False):
+                            # the learner recovers the trajectories from its own environments
+                            train_examples = [sample.to_compact() for sample in train_examples]
+                        else:
+                            for sample in train_examples:
+                                env_name = sample.trajectory.environment_name
+                                if env_name not in sent_context_env_names:
+                                    new_contexts[env_name] = sample.trajectory.context
+                            sent_context_env_names.update(new_contexts)
+
+                        self.train_queue.put((train_examples, samples_info, new_contexts))
                     else:
                         continue
 
@@ -368,6 +435,19 @@ class Actor(torch_mp.Process):
                 epoch_end = time.time()
                 print(f"[Actor {self.actor_id}] epoch {epoch_id} finished, took {epoch_end - epoch_start}s", file=sys.stderr)
 
+                if self.agent.context_encoding_cache is not None:
+                    cache_stat = self.agent.context_encoding_cache.stat()
+                    hit_rate = cache_stat['hit'] / max(cache_stat['hit'] + cache_stat['miss'], 1)
+                    print(f'[Actor {self.actor_id}] epoch {epoch_id} context encoding cache: '
+                          f'{cache_stat["hit"]} hits, {cache_stat["miss"]} misses (hit rate {hit_rate:.2%})',
+                          file=sys.stderr)
+
+                query_cache_stat = QueryCache.get_total_stats()
+                hit_rate = query_cache_stat['hit'] / max(query_cache_stat['hit'] + query_cache_stat['miss'], 1)
+                print(f'[Actor {self.actor_id}] epoch {epoch_id} executor query caches: '
+                      f'{query_cache_stat["hit"]} hits, {query_cache_stat["miss"]} misses (hit rate {hit_rate:.2%})',
+                      file=sys.stderr)
+
                 # buffer_content = dict()
                 # for env_name, samples in self.replay_buffer.all_samples().items():
                 #     buffer_content[env_name] = [dict(program=' '.join(sample.trajectory.program), prob=sample.prob) for sample in samples]
@@ -405,7 +485,8 @@ class Actor(torch_mp.Process):
                                  example_ids=example_ids,
                                  table_file=self.config['table_file'],
                                  table_representation_method=self.config['table_representation'],
-                                 bert_tokenizer=self.agent.encoder.bert_model.tokenizer)
+                                 bert_tokenizer=self.agent.encoder.bert_model.tokenizer,
+                                 use_columnar_store=self.config.get('use_columnar_table_store', False))
 
         setattr(self, 'environments', envs)
 
@@ -429,6 +510,11 @@ class Actor(torch_mp.Process):
             state_dict = torch.load(new_model_path, map_location=lambda storage, loc: storage)
             self.agent.load_state_dict(state_dict, strict=False)
             self.model_path = new_model_path
+            self.clear_context_encoding_cache()
+
+            # quantize the new weights of the encoder
+            if self.use_quantized_encoder:
+                self.agent.quantize_encoder()
 
             t2 = time.time()
             print('[Actor %s] loaded new model [%s] (took %.2f s)' % (self.actor_id, new_model_path, t2 - t1), file=sys.stderr)
@@ -437,6 +523,11 @@ class Actor(torch_mp.Process):
         else:
             return False
 
+    def clear_context_encoding_cache(self):
+        cache = self.agent.context_encoding_cache
+        if cache is not None:
+            cache.clear()
+
     def get_global_step(self):
         if not self.model_path:
             return 0
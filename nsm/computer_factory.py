@@ -4,8 +4,8 @@ from __future__ import print_function
 
 import json
 from collections import OrderedDict
+from collections.abc import MutableMapping
 import re
-import copy
 import sys
 import os
 import nsm.data_utils as data_utils
@@ -15,6 +15,8 @@ END_TK = data_utils.END_TK  # End of program token
 ERROR_TK = '<ERROR>'
 # SPECIAL_TKS = [END_TK, ERROR_TK, '(', ')']
 SPECIAL_TKS = [ERROR_TK, '(', ')']
+# names of the variables defined by programs, e.g., v0
+VAR_NAME_PATTERN = re.compile(r'v\d+')
 
 
 class LispInterpreter(object):
@@ -43,6 +45,8 @@ class LispInterpreter(object):
         # Initialize the parser state.
         self.n_exp = 0
         self.history = []
+        # variables read in the history, used to check for extra work
+        self.used_var_names = set()
         self.exp_stack = []
         self.done = False
         self.result = None
@@ -105,6 +109,7 @@ class LispInterpreter(object):
         else:
             self.namespace = Namespace()
         self.history = []
+        self.used_var_names = set()
         self.n_exp = 0
         self.exp_stack = []
         self.done = False
@@ -120,6 +125,8 @@ class LispInterpreter(object):
                 (self.namespace.n_var >= self.max_mem)):
             token = END_TK
         new_exp = self.parse_step(token)
+        if VAR_NAME_PATTERN.fullmatch(token):
+            self.used_var_names.add(token)
         # If reads in end of program, then return the last value as result.
         if token == END_TK:
             self.done = True
@@ -174,8 +181,12 @@ class LispInterpreter(object):
                         args[pos], self.get_type_ancestors)
                     if self.autocomplete is not None:
                         valid_tokens = result
-                        evaled_exp = [self.eval(item) for item in exp]
-                        evaled_tokens = [self.eval(tk) for tk in valid_tokens]
+                        evaled_exp = [
+                            self.namespace.get_object(item) if is_symbol(item) else self.eval(item)
+                            for item in exp]
+                        # autocomplete functions only read the values of the
+                        # candidates, so there is no need to copy them by `eval`.
+                        evaled_tokens = [self.namespace.get_object(tk) for tk in valid_tokens]
                         result = self.autocomplete(
                             evaled_exp, valid_tokens, evaled_tokens, self.namespace)
             # If at the beginning of a new expression.
@@ -319,20 +330,26 @@ class LispInterpreter(object):
             # generating it is some extra work that should not be
             # done.
             if ((not obj['is_constant']) and
-                    (var_name not in self.history) and
+                    (var_name not in self.used_var_names) and
                     (var_name != self.namespace.last_var)):
                 return True
         return False
 
     def clone(self):
         """Make a copy of itself, used in search."""
-        new = LispInterpreter(
-            self.type_hierarchy, self.max_mem, self.max_n_exp, self.assisted)
+        # bypass `__init__` to share the type ancestry with the clone
+        new = LispInterpreter.__new__(LispInterpreter)
+        new.__dict__.update(self.__dict__)
 
         new.history = self.history[:]
-        new.exp_stack = copy.deepcopy(self.exp_stack)
+        new.used_var_names = set(self.used_var_names)
+        # only the innermost lists of the stack are appended to
+        # by the parser, completed sub-expressions are never modified
+        new.exp_stack = [exp[:] for exp in self.exp_stack]
         new.n_exp = self.n_exp
         new.namespace = self.namespace.clone()
+        new.done = False
+        new.result = None
         return new
 
     def get_vocab(self):
@@ -344,7 +361,7 @@ class LispInterpreter(object):
         return vocab
 
 
-class Namespace(OrderedDict):
+class Namespace(MutableMapping):
     """Namespace is a mapping from names to values.
 
   Namespace maintains the mapping from names to their
@@ -353,17 +370,75 @@ class Namespace(OrderedDict):
   variables that fulfill some type constraints, (for
   example, find all the functions or find all the entity
   lists).
+
+  Entries are stored in two layers: an immutable base layer
+  shared by all the clones of a namespace, holding functions
+  and constants, and a per-clone overlay holding entries
+  written after the namespace is frozen (e.g., variables
+  v{n} defined by the program). This makes cloning cost
+  proportional to the number of written variables.
   """
 
     def __init__(self, *args, **kwargs):
         """Initialize the namespace with a list of functions."""
         # params = dict(zip(names, objs))
-        super(Namespace, self).__init__(*args, **kwargs)
+        self._base = OrderedDict()
+        # names in the base layer fulfilling a type constraint, shared by all
+        # the clones of the namespace, keyed by the types of the constraint
+        self._base_valid_tokens = dict()
+        self._overlay = OrderedDict(*args, **kwargs)
         self.n_var = 0
         self.last_var = None
 
+    def __getitem__(self, name):
+        try:
+            return self._overlay[name]
+        except KeyError:
+            return self._base[name]
+
+    def __setitem__(self, name, value):
+        self._overlay[name] = value
+
+    def __delitem__(self, name):
+        if name in self._overlay:
+            del self._overlay[name]
+        else:
+            # rare case, copy the shared base layer instead of modifying it
+            if name not in self._base:
+                raise KeyError(name)
+            self._base = OrderedDict((k, v) for k, v in self._base.items() if k != name)
+            self._base_valid_tokens = dict()
+
+    def __contains__(self, name):
+        return name in self._overlay or name in self._base
+
+    def __iter__(self):
+        for name in self._base:
+            if name not in self._overlay:
+                yield name
+
+        for name in self._overlay:
+            yield name
+
+    def __len__(self):
+        return len(self._base) + sum(1 for name in self._overlay if name not in self._base)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, list(self.items()))
+
+    def freeze(self):
+        """Move all entries into the base layer shared with future clones."""
+        if self._overlay:
+            base = OrderedDict(self.items())
+            self._base = base
+            self._base_valid_tokens = dict()
+            self._overlay = OrderedDict()
+
     def clone(self):
-        new = Namespace(self)
+        new = Namespace()
+        new._base = self._base
+        new._base_valid_tokens = self._base_valid_tokens
+        new._overlay = OrderedDict(self._overlay)
         new.n_var = self.n_var
         new.last_var = self.last_var
         return new
@@ -383,13 +458,31 @@ class Namespace(OrderedDict):
 
     def valid_tokens(self, constraint, get_type_ancestors):
         """Return all the names/tokens that fulfill the constraint."""
-        return [k for k, v in self.items()
+        # Entries in the base layer are checked once for each constraint,
+        # only entries in the overlay (e.g., variables) are checked per call.
+        key = tuple(constraint['types'])
+        base_tokens = self._base_valid_tokens.get(key)
+        if base_tokens is None:
+            base_tokens = self._base_valid_tokens[key] = [
+                k for k, v in self._base.items()
                 if self._is_token_valid(v, constraint, get_type_ancestors)]
 
+        overlay = self._overlay
+        if overlay:
+            tokens = [k for k in base_tokens if k not in overlay]
+            tokens.extend(
+                k for k, v in overlay.items()
+                if self._is_token_valid(v, constraint, get_type_ancestors))
+        else:
+            tokens = list(base_tokens)
+
+        return tokens
+
     def _is_token_valid(self, token, constraint, get_type_ancestors):
         """Determine if the token fulfills the given constraint."""
         type = token['type']
-        return set(get_type_ancestors(type) + [type]).intersection(constraint['types'])
+        types = constraint['types']
+        return type in types or any(ancestor in types for ancestor in get_type_ancestors(type))
 
     def get_value(self, name):
         return self[name]['value']
@@ -407,10 +500,11 @@ class Namespace(OrderedDict):
         return self.keys()
 
     def reset_variables(self):
-        keys = list(self.keys())
-        for k in keys:
-            if re.match(r'v\d+', k):
-                del self[k]
+        self._base = OrderedDict(
+            (k, v) for k, v in self._base.items() if not re.match(r'v\d+', k))
+        self._base_valid_tokens = dict()
+        self._overlay = OrderedDict(
+            (k, v) for k, v in self._overlay.items() if not re.match(r'v\d+', k))
         self.n_var = 0
         self.last_var = None
 
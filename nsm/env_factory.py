@@ -1,6 +1,6 @@
 "A collections of environments of sequence generations tasks."
 import sys
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Callable
 import collections
 import pprint
 import numpy as np
@@ -9,16 +9,34 @@ import numpy as np
 import torch
 import nsm.computer_factory as computer_factory
 
-import bloom_filter
-
 
 class Observation(object):
-    def __init__(self, read_ind, write_ind, valid_action_indices, output_features=None, valid_action_mask=None):
+    __slots__ = ('read_ind', 'write_ind', 'valid_action_indices', '_output_features', 'valid_action_mask',
+                 'id_feature_matrix')
+
+    def __init__(self, read_ind, write_ind, valid_action_indices, output_features=None, valid_action_mask=None,
+                 id_feature_matrix=None):
+        """
+        id_feature_matrix: if `output_features` is None, the matrix of output features
+            of the environment indexed by action id, to look up the features of the valid actions.
+        """
         self.read_ind = read_ind
         self.write_ind = write_ind
         self.valid_action_indices = valid_action_indices
-        self.output_features = output_features
+        self._output_features = output_features
         self.valid_action_mask = valid_action_mask
+        self.id_feature_matrix = id_feature_matrix
+
+    @property
+    def output_features(self):
+        if self._output_features is None and self.id_feature_matrix is not None:
+            return self.id_feature_matrix[self.valid_action_indices]
+
+        return self._output_features
+
+    @output_features.setter
+    def output_features(self, output_features):
+        self._output_features = output_features
 
     def to(self, device: torch.device):
         if self.read_ind.device == device:
@@ -43,8 +61,8 @@ class Observation(object):
     def remove_action(self, action_id):
         action_rel_id = self.valid_action_indices.index(action_id)
         del self.valid_action_indices[action_rel_id]
-        if self.output_features:
-            del self.output_features[action_rel_id]
+        if self._output_features:
+            del self._output_features[action_rel_id]
 
     @staticmethod
     def empty():
@@ -62,6 +80,32 @@ class Observation(object):
 
         return valid_action_mask
 
+    @staticmethod
+    def flatten_valid_actions(obs: List['Observation']):
+        """Concatenate the valid actions of the observations, and their output features.
+
+        Returns:
+            the number of valid actions of each observation, the concatenated valid
+            action ids, and the concatenated output features.
+        """
+        valid_action_ids = [np.asarray(ob.valid_action_indices, dtype=np.int64) for ob in obs]
+        num_valid_actions = np.array([len(action_ids) for action_ids in valid_action_ids], dtype=np.int64)
+
+        output_features = [
+            np.asarray(ob.output_features, dtype=np.float32)
+            for ob, action_ids in zip(obs, valid_action_ids)
+            if len(action_ids) > 0
+        ]
+        if output_features:
+            output_features = np.concatenate(output_features)
+        else:
+            feat_num = next((ob.id_feature_matrix.shape[1] for ob in obs if ob.id_feature_matrix is not None), 1)
+            output_features = np.zeros((0, feat_num), dtype=np.float32)
+
+        valid_action_ids = np.concatenate(valid_action_ids) if valid_action_ids else np.zeros(0, dtype=np.int64)
+
+        return num_valid_actions, valid_action_ids, output_features
+
     @staticmethod
     def to_batched_input(obs: List['Observation'], memory_size) -> 'Observation':
         batch_size = len(obs)
@@ -69,46 +113,65 @@ class Observation(object):
         read_ind = torch.tensor([ob.read_ind for ob in obs])
         write_ind = torch.tensor([ob.write_ind for ob in obs])
 
-        # pad output features
-        feat_num = len(obs[0].output_features[0])
+        # scatter the valid actions of all the observations at once
+        num_valid_actions, valid_action_ids, valid_action_feats = Observation.flatten_valid_actions(obs)
+        batch_ids = np.repeat(np.arange(batch_size), num_valid_actions)
+
+        feat_num = valid_action_feats.shape[-1]
         output_feats = np.zeros((batch_size, memory_size, feat_num), dtype=np.float32)
-        valid_action_mask = torch.zeros(batch_size, memory_size)
+        valid_action_mask = np.zeros((batch_size, memory_size), dtype=np.float32)
 
-        for i, observation in enumerate(obs):
-            if observation.valid_action_indices:
-                output_feats[i, observation.valid_action_indices] = observation.output_features
-                valid_action_mask[i, observation.valid_action_indices] = 1.
+        output_feats[batch_ids, valid_action_ids] = valid_action_feats
+        valid_action_mask[batch_ids, valid_action_ids] = 1.
 
         output_feats = torch.from_numpy(output_feats)
-
-        # valid_action_mask = Observation.get_valid_action_masks(obs, memory_size=memory_size)
+        valid_action_mask = torch.from_numpy(valid_action_mask)
 
         return Observation(read_ind, write_ind, None, output_feats, valid_action_mask)
 
     @staticmethod
     def to_batched_sequence_input(obs_seq: List[List['Observation']], memory_size) -> 'Observation':
         batch_size = len(obs_seq)
-        seq_len = max(len(ob_seq) for ob_seq in obs_seq)
+        seq_lens = [len(ob_seq) for ob_seq in obs_seq]
+        seq_len = max(seq_lens)
 
-        read_ind = torch.zeros(batch_size, seq_len, dtype=torch.long)
-        write_ind = torch.zeros(batch_size, seq_len, dtype=torch.long).fill_(-1.)
-        valid_action_mask = torch.zeros(batch_size, seq_len, memory_size)
-        feat_num = len(obs_seq[0][0].output_features[0])
-        output_feats = np.zeros((batch_size, seq_len, memory_size, feat_num), dtype=np.float32)
+        read_ind = np.zeros((batch_size, seq_len), dtype=np.int64)
+        write_ind = np.full((batch_size, seq_len), -1, dtype=np.int64)
 
-        for batch_id in range(batch_size):
-            ob_seq_i = obs_seq[batch_id]
-            for t in range(len(ob_seq_i)):
-                ob = obs_seq[batch_id][t]
-                read_ind[batch_id, t] = ob.read_ind
-                write_ind[batch_id, t] = ob.write_ind
+        # positions of the observations in the batch
+        batch_ids = np.repeat(np.arange(batch_size), seq_lens)
+        time_ids = np.concatenate([np.arange(n) for n in seq_lens])
 
-                valid_action_mask[batch_id, t, ob.valid_action_indices] = 1.
-                output_feats[batch_id, t, ob.valid_action_indices] = ob.output_features
+        obs = [ob for ob_seq in obs_seq for ob in ob_seq]
+        read_ind[batch_ids, time_ids] = [ob.read_ind for ob in obs]
+        write_ind[batch_ids, time_ids] = [ob.write_ind for ob in obs]
 
-        output_feats = torch.from_numpy(output_feats)
+        num_valid_actions, valid_action_ids, valid_action_feats = Observation.flatten_valid_actions(obs)
 
-        return Observation(read_ind, write_ind, None, output_feats, valid_action_mask)
+        return Observation.scatter_valid_actions(
+            read_ind, write_ind,
+            np.repeat(batch_ids, num_valid_actions), np.repeat(time_ids, num_valid_actions),
+            valid_action_ids, valid_action_feats,
+            memory_size)
+
+    @staticmethod
+    def scatter_valid_actions(read_ind: np.ndarray, write_ind: np.ndarray,
+                              batch_ids: np.ndarray, time_ids: np.ndarray,
+                              valid_action_ids: np.ndarray, valid_action_feats: np.ndarray,
+                              memory_size) -> 'Observation':
+        """Create the batched observation of a sequence, given the (batch, time, action)
+        indices of all the valid actions and their output features."""
+        batch_size, seq_len = read_ind.shape
+        feat_num = valid_action_feats.shape[-1]
+
+        valid_action_mask = np.zeros((batch_size, seq_len, memory_size), dtype=np.float32)
+        output_feats = np.zeros((batch_size, seq_len, memory_size, feat_num), dtype=np.float32)
+
+        valid_action_mask[batch_ids, time_ids, valid_action_ids] = 1.
+        output_feats[batch_ids, time_ids, valid_action_ids] = valid_action_feats
+
+        return Observation(torch.from_numpy(read_ind), torch.from_numpy(write_ind), None,
+                           torch.from_numpy(output_feats), torch.from_numpy(valid_action_mask))
 
     def __repr__(self):
         return f'Observation(read_id={repr(self.read_ind)}, write_id={repr(self.write_ind)}, ' \
@@ -117,7 +180,32 @@ class Observation(object):
     __str__ = __repr__
 
 
+def to_action_id_array(action_ids) -> np.ndarray:
+    """Store action ids as int16 if they fit, otherwise int32."""
+    action_ids = np.asarray(action_ids, dtype=np.int32)
+    int16_info = np.iinfo(np.int16)
+    if action_ids.size == 0 or (int16_info.min <= action_ids.min() and action_ids.max() <= int16_info.max):
+        action_ids = action_ids.astype(np.int16)
+
+    return action_ids
+
+
 class Trajectory(object):
+    """
+    A program together with the observations of each step generating it.
+
+    Observations are stored as arrays of action ids, and the features of the valid
+    actions are looked up from the feature matrix of the environment when needed.
+    The context is the one of the environment, shared by all its trajectories.
+    Pickled trajectories only carry their environment name as the key of their
+    context, which the receiving process sets back (see `Learner`).
+    """
+
+    __slots__ = ('id', 'environment_name', 'context', 'tgt_action_ids', 'answer', 'reward',
+                 'program', 'human_readable_program',
+                 '_read_ids', '_write_ids', '_valid_action_ids', '_valid_action_offsets',
+                 '_observations', '_observation_fn', '_hash')
+
     def __init__(self, environment_name: str,
                  observations: List[Observation],
                  context: Dict,
@@ -126,13 +214,19 @@ class Trajectory(object):
                  reward: float,
                  program: List[str] = None,
                  human_readable_program: List[str] = None,
-                 id: str = None):
+                 id: str = None,
+                 observation_fn: Callable[[], List[Observation]] = None):
+        """
+        observation_fn: if `observations` is None, a function to compute
+            the observations when they are first accessed.
+        """
         self.id = id
         self.environment_name = environment_name
-
-        self.observations = observations
         self.context = context
-        self.tgt_action_ids = tgt_action_ids
+
+        self._set_observations(observations)
+        self._observation_fn = observation_fn
+        self.tgt_action_ids = to_action_id_array(tgt_action_ids)
         self.answer = answer
         self.reward = reward
         self.program = program
@@ -140,6 +234,75 @@ class Trajectory(object):
 
         self._hash = hash((self.environment_name, ' '.join(str(a) for a in self.tgt_action_ids)))
 
+    def _set_observations(self, observations: List[Observation]):
+        self._observations = None
+        if observations is None:
+            self._read_ids = self._write_ids = None
+            self._valid_action_ids = self._valid_action_offsets = None
+            return
+
+        self._read_ids = to_action_id_array([ob.read_ind for ob in observations])
+        self._write_ids = to_action_id_array([ob.write_ind for ob in observations])
+
+        valid_action_offsets = np.zeros(len(observations) + 1, dtype=np.int32)
+        valid_action_offsets[1:] = np.cumsum([len(ob.valid_action_indices) for ob in observations])
+        self._valid_action_offsets = valid_action_offsets
+        self._valid_action_ids = to_action_id_array(
+            [action_id for ob in observations for action_id in ob.valid_action_indices])
+
+    def _compute_observations(self):
+        if self._read_ids is None and self._observation_fn is not None:
+            self._set_observations(self._observation_fn())
+            self._observation_fn = None
+
+    @property
+    def observations(self) -> List[Observation]:
+        if self._observations is not None:
+            return self._observations
+
+        self._compute_observations()
+        if self._read_ids is None:
+            return None
+
+        id_feature_matrix = self.context['id_feature_matrix']
+        observations = []
+        for t in range(len(self._read_ids)):
+            valid_action_ids = self._valid_action_ids[self._valid_action_offsets[t]:self._valid_action_offsets[t + 1]]
+            observations.append(Observation(int(self._read_ids[t]),
+                                            int(self._write_ids[t]),
+                                            valid_action_ids,
+                                            id_feature_matrix=id_feature_matrix))
+
+        # built once, so that in-place changes (e.g., `Observation.to`) are kept
+        self._observations = observations
+
+        return observations
+
+    @observations.setter
+    def observations(self, observations: List[Observation]):
+        self._set_observations(observations)
+        self._observation_fn = None
+
+    def __getstate__(self):
+        # observations are computed before sending the trajectory to other processes.
+        # The context is not sent: the receiving process sets it back from the
+        # environment name.
+        self._compute_observations()
+        state = {
+            field: getattr(self, field)
+            for field in Trajectory.__slots__
+            if field not in ('context', '_observations', '_observation_fn')
+        }
+
+        return state
+
+    def __setstate__(self, state):
+        for field, value in state.items():
+            setattr(self, field, value)
+        self.context = None
+        self._observations = None
+        self._observation_fn = None
+
     def __hash__(self):
         return self._hash
 
@@ -168,48 +331,96 @@ class Trajectory(object):
         )
 
     @classmethod
-    def from_program(cls, env, program):
+    def from_program(cls, env, program, lazy_observations=True):
+        """Create the trajectory of a program.
+
+        With `lazy_observations`, the program is only executed to get its
+        result, and the observations (valid actions and their features at
+        each step) are computed when they are first used, e.g., in training.
+        """
+        if not lazy_observations:
+            env = env.clone()
+            env.use_cache = False
+            env.replay_program(program)
+
+            return Trajectory.from_environment(env)
+
+        start_env = env.clone()
         env = env.clone()
         env.use_cache = False
-        ob = env.start_ob
+        env.execute_program(program)
 
-        for token in program:
-            action_id = env.de_vocab.lookup(token)
-            # try:
-            rel_action_id = ob.valid_action_indices.index(action_id)
-            # except ValueError:
-            #    return None
+        trajectory = Trajectory(
+            env.name,
+            observations=None,
+            context=env.get_context(),
+            tgt_action_ids=env.mapped_actions,
+            answer=env.interpreter.result,
+            reward=env.rewards[-1],
+            program=env.program,
+            human_readable_program=env.to_human_readable_program(),
+            observation_fn=lambda: Trajectory._replay_observations(start_env, program)
+        )
 
-            ob, _, _, _ = env.step(rel_action_id)
+        return trajectory
 
-        trajectory = Trajectory.from_environment(env)
+    @staticmethod
+    def _replay_observations(env, program):
+        env = env.clone()
+        env.use_cache = False
+        env.replay_program(program)
 
-        return trajectory
+        return env.obs
 
     @classmethod
     def to_batched_sequence_tensors(cls, trajectories: List['Trajectory'], memory_size):
         batch_size = len(trajectories)
 
-        obs_seq = [traj.observations for traj in trajectories]
-        max_seq_len = max(len(ob_seq) for ob_seq in obs_seq)
+        for traj in trajectories:
+            traj._compute_observations()
 
-        batched_obs_seq = Observation.to_batched_sequence_input(obs_seq, memory_size=memory_size)
+        seq_lens = [len(traj._read_ids) for traj in trajectories]
+        max_seq_len = max(seq_lens)
 
+        read_ind = np.zeros((batch_size, max_seq_len), dtype=np.int64)
+        write_ind = np.full((batch_size, max_seq_len), -1, dtype=np.int64)
         tgt_action_ids = np.zeros((batch_size, max_seq_len), dtype=np.int64)
-        tgt_action_mask = torch.zeros(batch_size, max_seq_len)
-        for batch_id in range(batch_size):
-            traj_i_action_ids = trajectories[batch_id].tgt_action_ids
-            tgt_action_ids[batch_id, :len(traj_i_action_ids)] = traj_i_action_ids
-            tgt_action_mask[batch_id, :len(traj_i_action_ids)] = 1.
-
-        tgt_action_ids = torch.from_numpy(tgt_action_ids)
-
-        return batched_obs_seq, dict(tgt_action_ids=tgt_action_ids, tgt_action_mask=tgt_action_mask)
+        tgt_action_mask = np.zeros((batch_size, max_seq_len), dtype=np.float32)
+
+        # (batch, time, action) indices of the valid actions of all trajectories,
+        # with their features gathered from the feature matrix of each environment
+        batch_ids = []
+        time_ids = []
+        valid_action_ids = []
+        valid_action_feats = []
+        for batch_id, traj in enumerate(trajectories):
+            seq_len = seq_lens[batch_id]
+            read_ind[batch_id, :seq_len] = traj._read_ids
+            write_ind[batch_id, :seq_len] = traj._write_ids
+            tgt_action_ids[batch_id, :len(traj.tgt_action_ids)] = traj.tgt_action_ids
+            tgt_action_mask[batch_id, :len(traj.tgt_action_ids)] = 1.
+
+            traj_valid_action_ids = traj._valid_action_ids.astype(np.int64)
+            batch_ids.append(np.full(len(traj_valid_action_ids), batch_id, dtype=np.int64))
+            time_ids.append(np.repeat(np.arange(seq_len), np.diff(traj._valid_action_offsets)))
+            valid_action_ids.append(traj_valid_action_ids)
+            valid_action_feats.append(traj.context['id_feature_matrix'][traj_valid_action_ids])
+
+        batched_obs_seq = Observation.scatter_valid_actions(
+            read_ind, write_ind,
+            np.concatenate(batch_ids), np.concatenate(time_ids),
+            np.concatenate(valid_action_ids), np.concatenate(valid_action_feats),
+            memory_size)
+
+        return batched_obs_seq, dict(tgt_action_ids=torch.from_numpy(tgt_action_ids),
+                                     tgt_action_mask=torch.from_numpy(tgt_action_mask))
 
 
 class Environment(object):
     """Environment with OpenAI Gym like interface."""
 
+    __slots__ = ()
+
     def step(self, action):
         """
         Args:
@@ -229,12 +440,70 @@ ProgrammingObservation = collections.namedtuple(
     'ProgramObservation', ['last_actions', 'output', 'valid_actions'])
 
 
+class History(object):
+    """
+    A persistent sequence stored as a linked list of nodes pointing to their
+    parents. Appending creates a new node and leaves the history unchanged, so
+    the clones of an environment share the common prefix of their histories.
+    """
+
+    __slots__ = ('value', 'parent', 'length')
+
+    def __init__(self, value=None, parent: 'History' = None):
+        self.value = value
+        self.parent = parent
+        self.length = parent.length + 1 if parent is not None else 0
+
+    def append(self, value) -> 'History':
+        return History(value, self)
+
+    def to_list(self) -> List:
+        values = [None] * self.length
+        node = self
+        for i in range(self.length - 1, -1, -1):
+            values[i] = node.value
+            node = node.parent
+
+        return values
+
+    @classmethod
+    def from_list(cls, values) -> 'History':
+        history = cls()
+        for value in values:
+            history = history.append(value)
+
+        return history
+
+    def __len__(self):
+        return self.length
+
+
+def history_property(field):
+    """A list view of the `History` stored in `field`."""
+    return property(lambda self: getattr(self, field).to_list(),
+                    lambda self, values: setattr(self, field, History.from_list(values)))
+
+
 class QAProgrammingEnv(Environment):
     """
     An RL environment wrapper around an interpreter to
     learn to write programs based on question.
     """
 
+    __slots__ = ('name', 'de_vocab', 'end_action', 'score_fn', 'interpreter', 'answer',
+                 'question_annotation', 'kg', 'constants', 'punish_extra_work', 'error',
+                 'trigger_words_dict', 'n_builtin', 'n_mem', 'n_exp',
+                 'context', 'id_feature_dict', 'id_feature_matrix', 'cache', 'cache_node', 'use_cache',
+                 '_actions', '_mapped_actions', '_program', '_rewards', '_obs',
+                 'done', 'valid_actions', 'start_ob')
+
+    # histories of the environment, shared with its clones
+    actions = history_property('_actions')
+    mapped_actions = history_property('_mapped_actions')
+    program = history_property('_program')
+    rewards = history_property('_rewards')
+    obs = history_property('_obs')
+
     def __init__(self,
                  question_annotation,
                  kg,
@@ -243,11 +512,18 @@ class QAProgrammingEnv(Environment):
                  de_vocab=None, constants=None,
                  punish_extra_work=True,
                  init_interp=True, trigger_words_dict=None,
-                 max_cache_size=1e4,
                  context=None, id_feature_dict=None,
                  cache=None,
                  reset=True,
+                 constants_initialized=False,
+                 prop_ids=None,
                  name='qa_programming'):
+        """
+        constants_initialized: whether `constants` are already added to the interpreter,
+            e.g., by a template shared by all the environments over the same table.
+        prop_ids: list of (action id, property) of the constants in the interpreter
+            holding properties, used to create output features.
+        """
 
         self.name = name
         self.de_vocab = de_vocab or interpreter.get_vocab()
@@ -275,14 +551,15 @@ class QAProgrammingEnv(Environment):
 
             constant_spans = []
             constant_values = []
+            added_constant_names = []
             if constants is None:
                 constants = []
             for c in constants:
                 constant_spans.append([-1, -1])
                 constant_values.append(c['value'])
-                if init_interp:
-                    self.interpreter.add_constant(
-                        value=c['value'], type=c['type'])
+                if init_interp and not constants_initialized:
+                    added_constant_names.append(self.interpreter.add_constant(
+                        value=c['value'], type=c['type']))
 
             for entity in question_annotation['entities']:
                 constant_spans.append(
@@ -290,11 +567,15 @@ class QAProgrammingEnv(Environment):
                 constant_values.append(entity['value'])
 
                 if init_interp:
-                    self.interpreter.add_constant(
-                        value=entity['value'], type=entity['type'])
+                    added_constant_names.append(self.interpreter.add_constant(
+                        value=entity['value'], type=entity['type']))
 
             constant_spans = constant_spans[:max_n_constants]
 
+            if init_interp:
+                # functions and constants are shared by all clones of the interpreter
+                self.interpreter.namespace.freeze()
+
             if len(constant_values) > (self.n_mem - self.n_exp):
                 print('Not enough memory slots for example {}, which has {} constants.'.format(
                     self.name, len(constant_values)))
@@ -312,15 +593,23 @@ class QAProgrammingEnv(Environment):
         else:
             prop_features = question_annotation['prop_features']
             feat_num = len(list(prop_features.values())[0])
-            self.id_feature_dict = {}
-            for name, id in self.de_vocab.vocab.items():
-                self.id_feature_dict[id] = [0] * feat_num
-                if name in self.interpreter.namespace:
-                    val = self.interpreter.namespace[name]['value']
-                    if (isinstance(val, str)) and val in prop_features:
-                        self.id_feature_dict[id] = prop_features[val]
+
+            if prop_ids is None:
+                prop_ids = self.get_prop_ids(self.de_vocab.vocab.keys())
+            elif context is None and init_interp:
+                prop_ids = prop_ids + self.get_prop_ids(added_constant_names)
+
+            # actions without features share the same all-zero feature vector
+            zero_feature = [0] * feat_num
+            self.id_feature_dict = {id: zero_feature for id in self.de_vocab.vocab.values()}
+            for id, prop in prop_ids:
+                if prop in prop_features:
+                    self.id_feature_dict[id] = prop_features[prop]
 
         self.context['id_feature_dict'] = self.id_feature_dict
+        if 'id_feature_matrix' not in self.context:
+            self.context['id_feature_matrix'] = self.get_id_feature_matrix()
+        self.id_feature_matrix = self.context['id_feature_matrix']
 
         if 'original_tokens' in self.context:
             self.context['original_tokens'] = question_annotation['original_tokens']
@@ -328,9 +617,17 @@ class QAProgrammingEnv(Environment):
         if cache:
             self.cache = cache
         else:
-            self.cache = SearchCache(name=name, max_elements=max_cache_size)
+            self.cache = SearchCache(name=name)
 
         self.use_cache = False
+        # node of the current program in the cache, advanced by one action per step,
+        # or None if it has to be looked up from the root
+        self.cache_node = None
+
+        self._actions = self._mapped_actions = self._program = self._rewards = self._obs = History()
+        self.done = False
+        self.valid_actions = []
+        self.start_ob = None
 
         if reset:
             self.reset()
@@ -338,15 +635,35 @@ class QAProgrammingEnv(Environment):
     def get_context(self):
         return self.context
 
+    def get_id_feature_matrix(self):
+        """Stack the output features of all the actions into a matrix indexed by action id."""
+        feat_num = len(next(iter(self.id_feature_dict.values())))
+        id_feature_matrix = np.zeros((max(self.id_feature_dict) + 1, feat_num), dtype=np.float32)
+        for id, features in self.id_feature_dict.items():
+            id_feature_matrix[id] = features
+
+        return id_feature_matrix
+
+    def get_prop_ids(self, names):
+        """Get the (action id, property) of the names holding properties in the interpreter."""
+        prop_ids = []
+        for name in names:
+            if name in self.de_vocab.vocab and name in self.interpreter.namespace:
+                val = self.interpreter.namespace[name]['value']
+                if isinstance(val, str):
+                    prop_ids.append((self.de_vocab.lookup(name), val))
+
+        return prop_ids
+
     def step(self, action, debug=False):
-        self.actions.append(action)
+        self._actions = self._actions.append(action)
         if debug:
             print('-' * 50)
             print(self.de_vocab.lookup(self.valid_actions, reverse=True))
             print('pick #{} valid action'.format(action))
             print('history:')
             print(self.de_vocab.lookup(self.mapped_actions, reverse=True))
-            print('env: {}, cache size: {}'.format(self.name, len(self.cache._set)))
+            print('env: {}, cache size: {}'.format(self.name, len(self.cache)))
             print('obs')
             pprint.pprint(self.obs)
 
@@ -354,7 +671,7 @@ class QAProgrammingEnv(Environment):
             mapped_action = self.valid_actions[action]
         else:
             print('-' * 50)
-            # print('env: {}, cache size: {}'.format(self.name, len(self.cache._set)))
+            # print('env: {}, cache size: {}'.format(self.name, len(self.cache)))
             print('action out of range.')
             print('action:')
             print(action)
@@ -368,9 +685,9 @@ class QAProgrammingEnv(Environment):
             print('-' * 50)
             mapped_action = self.valid_actions[action]
 
-        self.mapped_actions.append(mapped_action)
+        self._mapped_actions = self._mapped_actions.append(mapped_action)
         mapped_action_token = self.de_vocab.lookup(mapped_action, reverse=True)
-        self.program.append(mapped_action_token)
+        self._program = self._program.append(mapped_action_token)
 
         result = self.interpreter.read_token(mapped_action_token)
 
@@ -403,21 +720,29 @@ class QAProgrammingEnv(Environment):
         if self.use_cache:
             new_valid_actions = []
             cached_actions = []
-            partial_program = self.de_vocab.lookup(self.mapped_actions, reverse=True)
+            if self.cache_node is None:
+                cache_node = self.cache.get_node(self.mapped_actions)
+            else:
+                cache_node = self.cache.get_child(self.cache_node, mapped_action)
+            self.cache_node = cache_node
+            if not self.done:
+                self.cache.set_valid_actions(cache_node, valid_actions)
             for ma in valid_actions:
-                new_program = partial_program + [self.de_vocab.lookup(ma, reverse=True)]
-                if not self.cache.check(new_program):
+                if not self.cache.is_exhausted(cache_node, ma):
                     new_valid_actions.append(ma)
                 else:
                     cached_actions.append(ma)
             valid_actions = new_valid_actions
+        else:
+            # the trie is only extended with the programs explored with the cache
+            self.cache_node = None
 
         self.valid_actions = valid_actions
-        self.rewards.append(reward)
+        self._rewards = self._rewards.append(reward)
         ob = Observation(read_ind=mapped_action,
                          write_ind=new_var_id,
                          valid_action_indices=self.valid_actions,
-                         output_features=[self.id_feature_dict[a] for a in valid_actions])
+                         id_feature_matrix=self.id_feature_matrix)
 
         # If no valid actions are available, then stop.
         if not self.valid_actions:
@@ -440,75 +765,124 @@ class QAProgrammingEnv(Environment):
                 valid_actions = self.valid_actions + cached_actions
 
                 true_ob = Observation(read_ind=mapped_action, write_ind=new_var_id, valid_action_indices=valid_actions,
-                                      output_features=[self.id_feature_dict[a] for a in valid_actions])
-                self.obs.append(true_ob)
+                                      id_feature_matrix=self.id_feature_matrix)
+                self._obs = self._obs.append(true_ob)
             else:
-                self.obs.append(ob)
+                self._obs = self._obs.append(ob)
         elif self.use_cache:
             # If already finished, save it in the cache.
-            self.cache.save(self.de_vocab.lookup(self.mapped_actions, reverse=True))
+            self.cache.save(self.mapped_actions)
 
         return ob, reward, self.done, {}
         # 'valid_actions': valid_actions, 'new_var_id': new_var_id}
 
+    def replay_program(self, program):
+        """Step through a program token by token, computing the valid actions
+        and observations at each step. Raises `ValueError` if a token is not
+        a valid action."""
+        ob = self.start_ob
+        for token in program:
+            action_id = self.de_vocab.lookup(token)
+            rel_action_id = ob.valid_action_indices.index(action_id)
+            ob, _, _, _ = self.step(rel_action_id)
+
+    def execute_program(self, program):
+        """Execute a full program against the interpreter, without computing the
+        observations at each step. Used when only the result of a program is needed.
+        Like `replay_program`, the whole program is executed, and `ValueError` is
+        raised if a token is not a valid action. Returns the reward."""
+        reward = 0.0
+        self.cache_node = None
+        valid_tokens = self.interpreter.valid_tokens()
+        for token in program:
+            if token not in valid_tokens:
+                raise ValueError(f'{token} is not a valid action of env {self.name} '
+                                 f'after [{" ".join(self.program)}]')
+
+            self._mapped_actions = self._mapped_actions.append(self.de_vocab.lookup(token))
+            self._program = self._program.append(token)
+            self.interpreter.read_token(token)
+            self.done = self.interpreter.done
+
+            reward = 0.0
+            if self.done and not (self.punish_extra_work and self.interpreter.has_extra_work()):
+                reward = self.score_fn(self.interpreter.result, self.answer)
+
+            if self.done and self.interpreter.result == [computer_factory.ERROR_TK]:
+                self.error = True
+
+            self._rewards = self._rewards.append(reward)
+
+            valid_tokens = self.interpreter.valid_tokens()
+            # as in `step`, stop if no valid actions are available
+            if not valid_tokens:
+                self.done = True
+                self.error = True
+
+        return reward
+
     def reset(self):
-        self.actions = []
-        self.mapped_actions = []
-        self.program = []
-        self.rewards = []
+        self._actions = self._mapped_actions = self._program = self._rewards = History()
         self.done = False
+        self.cache_node = self.cache.root
         valid_actions = self.de_vocab.lookup(self.interpreter.valid_tokens())
+        # the valid actions of the root are recorded even if the cache is not used yet,
+        # as clones exploring with the cache start from here without resetting, and
+        # the cache is only full once all of them are exhausted
+        self.cache.set_valid_actions(self.cache.root, valid_actions)
         if self.use_cache:
             new_valid_actions = []
+            cache_node = self.cache.root
             for ma in valid_actions:
-                partial_program = self.de_vocab.lookup(
-                    self.mapped_actions + [ma], reverse=True)
-                if not self.cache.check(partial_program):
+                if not self.cache.is_exhausted(cache_node, ma):
                     new_valid_actions.append(ma)
             valid_actions = new_valid_actions
         self.valid_actions = valid_actions
         self.start_ob = Observation(self.de_vocab.decode_id,
                                     -1,
                                     valid_actions,
-                                    [self.id_feature_dict[a] for a in valid_actions])
-        self.obs = [self.start_ob]
+                                    id_feature_matrix=self.id_feature_matrix)
+        self._obs = History().append(self.start_ob)
 
     def interactive(self, assisted=False):
         self.interpreter.interactive(assisted=assisted) #debug
         print('reward is: %s' % self.score_fn(self.interpreter))
 
     def clone(self):
-        new_interpreter = self.interpreter.clone()
-        new = QAProgrammingEnv(
-            question_annotation=self.question_annotation,
-            kg=self.kg,
-            answer=self.answer,
-            score_fn=self.score_fn,
-            interpreter=new_interpreter,
-            de_vocab=self.de_vocab,
-            constants=self.constants,
-            init_interp=False,
-            context=self.context,
-            id_feature_dict=self.id_feature_dict,
-            cache=self.cache,
-            reset=False,
-        )
-        new.actions = self.actions[:]
-        new.mapped_actions = self.mapped_actions[:]
-        new.program = self.program[:]
-        new.rewards = self.rewards[:]
-        new.obs = self.obs[:]
-        new.done = self.done
+        # Only the interpreter is copied. The histories are persistent and never
+        # modified in place, and the other fields are either immutable or shared
+        # among all copies of this environment (e.g., the context and the cache),
+        # so they are referenced without going through `__init__`.
+        new = QAProgrammingEnv.__new__(QAProgrammingEnv)
         new.name = self.name
-        # Cache is shared among all copies of this environment.
+        new.de_vocab = self.de_vocab
+        new.end_action = self.end_action
+        new.score_fn = self.score_fn
+        new.interpreter = self.interpreter.clone()
+        new.answer = self.answer
+        new.question_annotation = self.question_annotation
+        new.kg = self.kg
+        new.constants = self.constants
+        new.punish_extra_work = self.punish_extra_work
+        new.error = self.error
+        new.trigger_words_dict = self.trigger_words_dict
+        new.n_builtin = self.n_builtin
+        new.n_mem = self.n_mem
+        new.n_exp = self.n_exp
+        new.context = self.context
+        new.id_feature_dict = self.id_feature_dict
+        new.id_feature_matrix = self.id_feature_matrix
         new.cache = self.cache
+        new.cache_node = self.cache_node
         new.use_cache = self.use_cache
+        new._actions = self._actions
+        new._mapped_actions = self._mapped_actions
+        new._program = self._program
+        new._rewards = self._rewards
+        new._obs = self._obs
+        new.done = self.done
         new.valid_actions = self.valid_actions
         new.start_ob = self.start_ob
-        new.error = self.error
-        new.id_feature_dict = self.id_feature_dict
-        new.punish_extra_work = self.punish_extra_work
-        new.trigger_words_dict = self.trigger_words_dict
 
         return new
 
@@ -544,27 +918,115 @@ class QAProgrammingEnv(Environment):
         return readable_program
 
 
+class SearchCacheNode(object):
+    """A node in the explored-program trie, corresponding to a program prefix."""
+    __slots__ = ('parent', 'action', 'children', 'valid_actions', 'n_exhausted_children', 'exhausted')
+
+    def __init__(self, parent=None, action=None):
+        self.parent = parent
+        self.action = action
+        self.children = dict()
+        # valid continuing actions of this prefix, set when it is first visited
+        self.valid_actions = None
+        self.n_exhausted_children = 0
+        self.exhausted = False
+
+
 class SearchCache(object):
-    def __init__(self, name, size=None, max_elements=1e4, error_rate=1e-8):
+    """Explored programs, stored in a trie over action ids.
+
+    A prefix is exhausted once it is a saved (finished) program, or once all of
+    its valid continuing actions are exhausted. The trie only grows with the
+    prefixes actually visited by the environments sharing it.
+    """
+
+    def __init__(self, name):
         self.name = name
-        self.max_elements = max_elements
-        self.error_rate = error_rate
-        self._set = bloom_filter.BloomFilter(
-            max_elements=max_elements, error_rate=error_rate)
+        self.root = SearchCacheNode()
+        self.n_programs = 0
+
+    def __len__(self):
+        return self.n_programs
+
+    def get_node(self, action_ids, create=True):
+        node = self.root
+        for action in action_ids:
+            if create:
+                node = self.get_child(node, action)
+            else:
+                node = node.children.get(action)
+                if node is None:
+                    return None
+
+        return node
+
+    def get_child(self, node, action):
+        child = node.children.get(action)
+        if child is None:
+            child = node.children[action] = SearchCacheNode(node, action)
+
+        return child
+
+    def is_exhausted(self, node, action):
+        child = node.children.get(action)
+
+        return child is not None and child.exhausted
+
+    def set_valid_actions(self, node, valid_actions):
+        """Record the valid continuing actions of a prefix, and mark it
+        exhausted if all of them are already exhausted."""
+        if node.valid_actions is not None:
+            return
+
+        node.valid_actions = frozenset(valid_actions)
+        node.n_exhausted_children = sum(
+            1 for action in node.valid_actions if self.is_exhausted(node, action))
 
-    def check(self, tokens):
-        return ' '.join(tokens) in self._set
+        if node.n_exhausted_children == len(node.valid_actions):
+            self._mark_exhausted(node)
 
-    def save(self, tokens):
-        string = ' '.join(tokens)
-        self._set.add(string)
+    def _mark_exhausted(self, node):
+        while not node.exhausted:
+            node.exhausted = True
+
+            parent = node.parent
+            if parent is None or parent.valid_actions is None or node.action not in parent.valid_actions:
+                break
+
+            parent.n_exhausted_children += 1
+            if parent.n_exhausted_children < len(parent.valid_actions):
+                break
+
+            node = parent
+
+    def check(self, action_ids):
+        node = self.get_node(action_ids, create=False)
+
+        return node is not None and node.exhausted
+
+    def save(self, action_ids):
+        node = self.get_node(action_ids)
+        if not node.exhausted:
+            self.n_programs += 1
+            self._mark_exhausted(node)
 
     def is_full(self):
-        return '(' in self._set
+        return self.root.exhausted
 
     def reset(self):
-        self._set = bloom_filter.BloomFilter(
-            max_elements=self.max_elements, error_rate=self.error_rate)
+        # the root is cleared in place, as environments keep it as their current node,
+        # and it keeps its valid actions, which are recorded when the environment is reset
+        valid_actions = self.root.valid_actions
+        self.root.__init__()
+        self.root.valid_actions = valid_actions
+        self.n_programs = 0
+
+
+# Compact form of a `Sample` to send to other processes, e.g., from actors to the learner.
+# It only identifies the program of the sample, and the receiving process recovers
+# the trajectory from its own copy of the environment.
+CompactSample = collections.namedtuple(
+    'CompactSample', ['environment_name', 'action_ids', 'weight', 'prob'])
 
 
 class Sample(object):
@@ -575,6 +1037,39 @@ class Sample(object):
         for field, value in kwargs.items():
             setattr(self, field, value)
 
+    def to_compact(self) -> CompactSample:
+        prob = self.prob.item() if isinstance(self.prob, torch.Tensor) else self.prob
+
+        return CompactSample(self.trajectory.environment_name,
+                             self.trajectory.tgt_action_ids,
+                             getattr(self, 'weight', None),
+                             prob)
+
+    @classmethod
+    def from_compact(cls, compact_sample: CompactSample, env: 'QAProgrammingEnv',
+                     trajectory_cache: Dict = None) -> 'Sample':
+        """Recover the sample from its compact form, using the environment of the sample.
+
+        trajectory_cache: optional dict of the trajectories recovered before, indexed by
+            environment name and action ids, so that a program is executed only once.
+        """
+        action_ids = compact_sample.action_ids.tolist()
+        cache_key = (compact_sample.environment_name, tuple(action_ids))
+
+        trajectory = trajectory_cache.get(cache_key) if trajectory_cache is not None else None
+        if trajectory is None:
+            program = env.de_vocab.lookup(action_ids, reverse=True)
+            trajectory = Trajectory.from_program(env, program)
+
+            if trajectory_cache is not None:
+                trajectory_cache[cache_key] = trajectory
+
+        kwargs = dict()
+        if compact_sample.weight is not None:
+            kwargs['weight'] = compact_sample.weight
+
+        return cls(trajectory, prob=compact_sample.prob, **kwargs)
+
     def to(self, device: torch.device):
         for ob in self.trajectory.observations:
             ob.to(device)
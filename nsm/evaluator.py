@@ -66,6 +66,10 @@ class Evaluator(torch_mp.Process):
         self.model_path = 'INIT_MODEL'
         self.message_var = None
 
+    @property
+    def use_quantized_encoder(self):
+        return self.config.get('quantize_encoder', False) and self.device.type == 'cpu'
+
     def run(self):
         # initialize cuda context
         self.device = torch.device(self.device)
@@ -78,6 +82,9 @@ class Evaluator(torch_mp.Process):
         agent_name = self.config.get('parser', 'vanilla')
         self.agent = get_parser_agent_by_name(agent_name).build(self.config, master='evaluator').to(self.device).eval()
 
+        if self.use_quantized_encoder:
+            self.agent.quantize_encoder()
+
         self.load_environments()
         summary_writer = SummaryWriter(os.path.join(self.config['work_dir'], 'tb_log/dev'))
 
@@ -118,7 +125,8 @@ class Evaluator(torch_mp.Process):
         envs = load_environments([self.eval_file],
                                  table_file=self.config['table_file'],
                                  table_representation_method=self.config['table_representation'],
-                                 bert_tokenizer=self.agent.encoder.bert_model.tokenizer)
+                                 bert_tokenizer=self.agent.encoder.bert_model.tokenizer,
+                                 use_columnar_store=self.config.get('use_columnar_table_store', False))
         for env in envs:
             env.use_cache = False
             env.punish_extra_work = False
@@ -138,6 +146,10 @@ class Evaluator(torch_mp.Process):
             self.agent.load_state_dict(state_dict)
             self.model_path = new_model_path
 
+            # quantize the new weights of the encoder
+            if self.use_quantized_encoder:
+                self.agent.quantize_encoder()
+
             t2 = time.time()
             print('[Evaluator] loaded new model [%s] (took %.2f s)' % (new_model_path, t2 - t1), file=sys.stderr)
 
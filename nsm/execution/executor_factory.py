@@ -1,9 +1,13 @@
 """Utility functions to interact with knowledge graph."""
 
 import pprint
+import operator
 import collections
 
+import numpy as np
+
 from nsm.execution.type_system import get_simple_type_hierarchy, DateTime
+from nsm.execution.table_store import TableStore, RowSet
 
 
 class Executor(object):
@@ -16,6 +20,62 @@ class Executor(object):
         raise NotImplementedError()
 
 
+class QueryCache(object):
+    """A bounded LRU memo for the results of knowledge graph queries.
+
+    The cache is owned by an executor, and therefore shared by every
+    environment (and its clones) built on top of the same executor.
+    There is one cache per table, so it is kept small: the queries of
+    the programs over a table only involve a few row sets.
+    """
+
+    # hits and misses of all the caches in the process
+    total_hit_count = 0
+    total_miss_count = 0
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        try:
+            val = self.entries[key]
+        except KeyError:
+            self.miss_count += 1
+            QueryCache.total_miss_count += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hit_count += 1
+        QueryCache.total_hit_count += 1
+
+        return val
+
+    def put(self, key, val):
+        self.entries[key] = val
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stat(self):
+        return {'size': len(self.entries), 'hit': self.hit_count, 'miss': self.miss_count}
+
+    @staticmethod
+    def get_total_stats():
+        return {'hit': QueryCache.total_hit_count, 'miss': QueryCache.total_miss_count}
+
+
 class SimpleKGExecutor(Executor):
     """This executor assumes that the knowledge graph is
     encoded as a dictionary.
@@ -33,6 +93,7 @@ class SimpleKGExecutor(Executor):
         self.num_props = kg_info['num_props']
         self.datetime_props = kg_info['datetime_props']
         self.props = kg_info['props']
+        self.query_cache = QueryCache()
 
     def hop(self, entities, prop, keep_dup=False):
         """Get the property of a list of entities."""
@@ -152,7 +213,7 @@ class SimpleKGExecutor(Executor):
         return pprint.pformat(self.kg, indent=2)
 
     def valid_props(self, source_mids, token_val_dict, target_mids=None, condition_fn=None):
-        connected_props = self.get_props(source_mids, target_mids, condition_fn=condition_fn)
+        connected_props = set(self.get_props(source_mids, target_mids, condition_fn=condition_fn))
         valid_tks = []
         for tk, prop in token_val_dict.items():
             if prop in connected_props:
@@ -160,18 +221,35 @@ class SimpleKGExecutor(Executor):
         return valid_tks
 
     def is_connected(self, source_ents, target_ents, prop):
+        cache_key = ('is_connected', frozenset(source_ents), frozenset(target_ents), prop)
+        result = self.query_cache.get(cache_key)
+        if result is not None:
+            return result
+
         cast_func = self.get_cast_func(prop)
 
         try:
             result = set(map(cast_func, self.hop(source_ents, prop))) == set(map(cast_func, target_ents))
         except:
-            return False
+            result = False
+
+        self.query_cache.put(cache_key, result)
 
         return result
 
     def get_props(
             self, source_ents, target_ents=None, debug=False, condition_fn=None):
         """Get the properties that goes from source to targets."""
+        # Only results computed with the default connectivity condition are memoized.
+        use_cache = condition_fn is None and not debug
+        if use_cache:
+            cache_key = (
+                'get_props', frozenset(source_ents),
+                frozenset(target_ents) if target_ents is not None else None)
+            props = self.query_cache.get(cache_key)
+            if props is not None:
+                return list(props)
+
         props = set()
         if condition_fn is None:
             condition_fn = self.is_connected
@@ -202,6 +280,9 @@ class SimpleKGExecutor(Executor):
             print(props)
             print('=' * 100)
 
+        if use_cache:
+            self.query_cache.put(cache_key, tuple(props))
+
         return list(props)
 
     def autocomplete_hop(self, exp, tokens, token_vals):
@@ -323,9 +404,240 @@ class SimpleKGExecutor(Executor):
 class TableExecutor(SimpleKGExecutor):
     """The executor for writing programs that processes simple Tables."""
 
-    def __init__(self, table_info):
+    # columnar view of the table used by vectorized operations,
+    # `None` if operations should run over the python dictionaries.
+    table_store = None
+    use_row_sets = False
+
+    def __init__(self, table_info, use_columnar_store=False, use_row_sets=True):
         super(TableExecutor, self).__init__(table_info)
         self.n_rows = len(table_info['row_ents'])
+        if use_columnar_store:
+            self.table_store = TableStore.build(table_info)
+            if self.table_store is not None:
+                for prop, column in self.table_store.columns.items():
+                    if column.is_ordered:
+                        self.build_sort_index(prop, column)
+        self.use_row_sets = use_row_sets and self.table_store is not None and self.table_store.supports_row_sets
+
+    def make_row_set(self, rows):
+        """Represent a list of rows (e.g., `all_rows`) as a `RowSet` if row sets are enabled,
+        so that the results of operations over it are row sets as well."""
+        if self.use_row_sets:
+            row_set = self.table_store.make_row_set(rows)
+            if row_set is not None:
+                return row_set
+
+        return rows
+
+    def is_row_set(self, ents):
+        return self.use_row_sets and isinstance(ents, RowSet)
+
+    def get_ordered_column(self, prop):
+        """Get the column of an ordered property from the columnar store, if available."""
+        if self.table_store is None:
+            return None
+
+        column = self.table_store.get_column(prop)
+        if column is not None and column.is_ordered:
+            return column
+
+        return None
+
+    def get_homogeneous_column(self, prop, single_valued=False):
+        """Get a column whose raw values can be aggregated without casting, if available."""
+        if self.table_store is None:
+            return None
+
+        column = self.table_store.get_column(prop)
+        if (
+            column is not None and column.is_homogeneous and
+            (column.is_single_valued or not single_valued)
+        ):
+            return column
+
+        return None
+
+    def get_indexed_column(self, prop):
+        """Get a column with an equality index from the columnar store, if available."""
+        if self.table_store is None:
+            return None
+
+        column = self.table_store.get_column(prop)
+        if column is not None and column.equality_index is not None:
+            return column
+
+        return None
+
+    def filter_by_equality(self, ents_1, ents_2, prop, negate=False):
+        """Look up the rows whose values of `prop` equal to `ents_2` in the equality index.
+        Returns `None` if the property is not indexed."""
+        column = self.get_indexed_column(prop)
+        if column is None:
+            return None
+
+        cast_func = self.get_cast_func(prop)
+        query_ents = frozenset(map(cast_func, ents_2))
+
+        # Entities without a value match an empty query, and entities not in the
+        # table are never in the index, leave these cases to the reference implementation.
+        if not query_ents or (negate and (self.table_store.to_row_ids(ents_1) < 0).any()):
+            return None
+
+        row_mask = column.get_equal_rows(query_ents)
+        if row_mask is None:
+            row_mask = np.zeros(self.table_store.n_rows, dtype=bool)
+        if negate:
+            row_mask = ~row_mask
+
+        return self.table_store.select(ents_1, row_mask)
+
+    def filter_equal(self, ents_1, ents_2, prop):
+        """From ents_1, filter out the entities whose property equal to ents_2."""
+        result = self.filter_by_equality(ents_1, ents_2, prop)
+        if result is not None:
+            return result
+
+        return super(TableExecutor, self).filter_equal(ents_1, ents_2, prop)
+
+    def filter_not_equal(self, ents_1, ents_2, prop):
+        """From ents_1, filter out the entities whose property equal to ents_2."""
+        result = self.filter_by_equality(ents_1, ents_2, prop, negate=True)
+        if result is not None:
+            return result
+
+        return super(TableExecutor, self).filter_not_equal(ents_1, ents_2, prop)
+
+    def is_connected(self, source_ents, target_ents, prop):
+        # `get_props` checks the connection of one entity at a time, which is a lookup in the equality index.
+        column = self.get_indexed_column(prop)
+        row_id = None
+        if column is not None and len(source_ents) == 1:
+            row_id = self.table_store.row_index.get(source_ents[0])
+        if row_id is None:
+            return super(TableExecutor, self).is_connected(source_ents, target_ents, prop)
+
+        try:
+            casted_target_ents = frozenset(map(self.get_cast_func(prop), target_ents))
+        except:
+            return False
+
+        row_mask = column.get_equal_rows(casted_target_ents)
+
+        return row_mask is not None and bool(row_mask[row_id])
+
+    def get_string_column(self, prop):
+        """Get a column of string values from the columnar store, if available."""
+        column = self.get_homogeneous_column(prop)
+        if column is not None and column.kind == 'string':
+            return column
+
+        return None
+
+    def get_substring_value_mask(self, column, string_list):
+        """Mask over the values of `column` that contain any of the strings,
+        `None` if some query is not a string."""
+        if not all(isinstance(string, str) for string in string_list):
+            return None
+
+        value_mask = np.zeros(len(column.raw_values), dtype=bool)
+        for string in string_list:
+            value_mask |= column.get_substring_mask(string)
+
+        return value_mask
+
+    def filter_by_substrings(self, ents, string_list, prop, negate=False):
+        """Look up the rows whose value of `prop` contains any of the strings in the
+        substring index. Returns `None` if the property is not indexed."""
+        column = self.get_string_column(prop)
+        if column is None:
+            return None
+
+        # The reference implementation requires every entity to have exactly one value.
+        ids = self.table_store.to_row_ids(ents)
+        if (ids < 0).any() or (column.n_values[ids] != 1).any():
+            return None
+
+        value_mask = self.get_substring_value_mask(column, string_list)
+        if value_mask is None:
+            return None
+
+        row_mask = np.zeros(self.table_store.n_rows, dtype=bool)
+        row_mask[column.row_ids[value_mask]] = True
+        if negate:
+            row_mask = ~row_mask
+
+        return self.table_store.select(ents, row_mask)
+
+    def filter_by_comparison(self, ents, nums, prop, op):
+        """Vectorized version of the filter operations over the columnar store.
+        Returns `None` if the property is not available in the store."""
+        column = self.get_ordered_column(prop)
+        if column is None:
+            return None
+
+        cast_func = self.get_cast_func(prop)
+        casted_query_ents = [cast_func(x) for x in nums]
+
+        value_mask = np.ones(len(column.row_ids), dtype=bool)
+        for query in casted_query_ents:
+            value_mask &= column.compare(op, query)
+
+        row_mask = np.zeros(self.table_store.n_rows, dtype=bool)
+        row_mask[column.row_ids[value_mask]] = True
+
+        return self.table_store.select(ents, row_mask)
+
+    def build_sort_index(self, prop, column):
+        """Pre-compute the values used by `sort_select` for every row, and the order
+        of the rows by these values, so that sorting is a masked lookup."""
+        if prop in self.num_props:
+            get_val = self.get_num_prop_val
+        else:
+            get_val = self.get_datetime_prop_val
+
+        try:
+            vals = [get_val(ent, prop) for ent in self.table_store.row_ents]
+        except Exception:
+            # Leave ill-formed values to the reference implementation.
+            return
+
+        if any(val is not None and val != val for val in vals):
+            return
+
+        column.sort_valid = np.array([val is not None for val in vals], dtype=bool)
+        column.sort_keys = np.array([val if val is not None else 0. for val in vals], dtype=np.float64)
+        valid_rows = np.flatnonzero(column.sort_valid)
+        column.sort_order = valid_rows[np.argsort(column.sort_keys[valid_rows], kind='stable')]
+
+    def sort_select(self, entities, prop, ind):
+        """Sort the entities using prop then select the i-th one."""
+        column = self.get_ordered_column(prop)
+        if column is None or column.sort_keys is None:
+            return super(TableExecutor, self).sort_select(entities, prop, ind)
+
+        ids = self.table_store.to_row_ids(entities)
+        keep = (ids >= 0) & column.sort_valid[ids]
+
+        if ind in (0, -1):
+            # The i-th smallest (or largest) value is the one of the first (or last)
+            # selected row in sorted order.
+            row_mask = np.zeros(self.table_store.n_rows, dtype=bool)
+            row_mask[ids[keep]] = True
+            selected_rows = column.sort_order[row_mask[column.sort_order]]
+            best_score = column.sort_keys[selected_rows[ind]]
+        else:
+            # Duplicated entities count in the ranking.
+            best_score = np.sort(column.sort_keys[ids[keep]])[ind]
+
+        best_row_mask = column.sort_valid & (column.sort_keys == best_score)
+        if self.is_row_set(entities):
+            return self.table_store.row_set_from_mask(self.table_store.get_row_mask(entities) & best_row_mask)
+
+        best_ent_ids = np.flatnonzero(keep & best_row_mask[ids])
+        result = [entities[i] for i in best_ent_ids]
+
+        return result
 
     def comparative_select(self, ents, prop, operator='ge'):
         """Select the entity list whose value of the given property is larger or equal to"""
@@ -363,6 +675,10 @@ class TableExecutor(SimpleKGExecutor):
 
     def filter_ge(self, ents_1, nums, prop):
         """Filter out entities whose prop >= nums."""
+        result = self.filter_by_comparison(ents_1, nums, prop, operator.ge)
+        if result is not None:
+            return result
+
         result = []
         cast_func = self.get_cast_func(prop)
 
@@ -377,6 +693,10 @@ class TableExecutor(SimpleKGExecutor):
 
     def filter_greater(self, ents_1, nums, prop):
         """Filter out entities whose prop > nums."""
+        result = self.filter_by_comparison(ents_1, nums, prop, operator.gt)
+        if result is not None:
+            return result
+
         result = []
         cast_func = self.get_cast_func(prop)
 
@@ -391,6 +711,10 @@ class TableExecutor(SimpleKGExecutor):
 
     def filter_le(self, ents_1, nums, prop):
         """Filter out entities whose prop <= nums."""
+        result = self.filter_by_comparison(ents_1, nums, prop, operator.le)
+        if result is not None:
+            return result
+
         result = []
         cast_func = self.get_cast_func(prop)
 
@@ -406,6 +730,10 @@ class TableExecutor(SimpleKGExecutor):
 
     def filter_less(self, ents_1, nums, prop):
         """Filter out entities whose prop < nums."""
+        result = self.filter_by_comparison(ents_1, nums, prop, operator.lt)
+        if result is not None:
+            return result
+
         result = []
         cast_func = self.get_cast_func(prop)
 
@@ -470,6 +798,10 @@ class TableExecutor(SimpleKGExecutor):
 
     def filter_str_contain_any(self, ents, string_list, prop):
         """Filter out entities whose prop contains any of the strings."""
+        result = self.filter_by_substrings(ents, string_list, prop)
+        if result is not None:
+            return result
+
         result = []
         for ent in ents:
             str_val_list = self.hop([ent], prop)
@@ -483,6 +815,10 @@ class TableExecutor(SimpleKGExecutor):
 
     def filter_str_contain_not_any(self, ents, string_list, prop):
         """Filter out entities, whose prop doesn't contain any of the strings."""
+        result = self.filter_by_substrings(ents, string_list, prop, negate=True)
+        if result is not None:
+            return result
+
         result = []
         for ent in ents:
             str_val_list = self.hop([ent], prop)
@@ -521,6 +857,15 @@ class TableExecutor(SimpleKGExecutor):
             for tk in tokens:
                 is_valid = False
                 prop = token_val_dict[tk]
+
+                column = self.get_string_column(prop)
+                if column is not None:
+                    value_mask = self.get_substring_value_mask(column, string_list)
+                    if value_mask is not None:
+                        if (value_mask & self.table_store.value_mask(source_ents, column)).any():
+                            valid_tks.append(tk)
+                        continue
+
                 str_val_list = self.hop(source_ents, prop)
                 # If one of the str_val contains any one of the
                 # string, then we can use this property.
@@ -551,6 +896,9 @@ class TableExecutor(SimpleKGExecutor):
         """Select all the rows that is right below the given rows respectively."""
         assert rows
         assert rows[0][:4] == 'row_'
+        if self.is_row_set(rows):
+            return self.table_store.row_set_from_int((rows.mask << 1) & self.table_store.full_mask)
+
         # row are in the pattern of row_0, row_1.
         row_ids = [int(row_str[4:]) for row_str in rows]
         new_row_ids = [(i + 1) for i in row_ids if i + 1 < self.n_rows]
@@ -565,6 +913,9 @@ class TableExecutor(SimpleKGExecutor):
         """Select all the rows that is right above the given rows respectively."""
         assert rows
         assert rows[0][:4] == 'row_'
+        if self.is_row_set(rows):
+            return self.table_store.row_set_from_int(rows.mask >> 1)
+
         row_ids = [int(row_str[4:]) for row_str in rows]
         new_row_ids = [(i - 1) for i in row_ids if i - 1 >= 0]
         if new_row_ids:
@@ -608,6 +959,10 @@ class TableExecutor(SimpleKGExecutor):
         """Take the first row (the one with minimum index) in all the rows."""
         assert len(rows) > 1
         assert rows[0][:4] == 'row_'
+        if self.is_row_set(rows):
+            # lowest set bit
+            return self.table_store.row_set_from_int(rows.mask & -rows.mask)
+
         # Return the row with the smallest id.
         row_ids = [int(row_str[4:]) for row_str in rows]
         result_row_id = min(row_ids)
@@ -618,6 +973,10 @@ class TableExecutor(SimpleKGExecutor):
         """Take the last row (the one with maximum index) in all the rows."""
         assert len(rows) > 1
         assert rows[0][:4] == 'row_'
+        if self.is_row_set(rows):
+            # highest set bit
+            return self.table_store.row_set_from_int(1 << (rows.mask.bit_length() - 1))
+
         # Return the row with the largest id.
         row_ids = [int(row_str[4:]) for row_str in rows]
         result_row_id = max(row_ids)
@@ -641,11 +1000,32 @@ class TableExecutor(SimpleKGExecutor):
     def count(self, ents):
         return [len(ents)]
 
+    def aggregate_num_values(self, ents, prop, reduce_fn):
+        """Apply `reduce_fn` to the number values of `ents` in the columnar store.
+        Returns `None` if the property is not available or no value is selected."""
+        column = self.get_homogeneous_column(prop)
+        if column is None or column.kind != 'num':
+            return None
+
+        vals = column.num_values[self.table_store.value_mask(ents, column)]
+        if len(vals) == 0:
+            return None
+
+        return [reduce_fn(vals).item()]
+
     def maximum(self, ents, prop):
+        result = self.aggregate_num_values(ents, prop, np.max)
+        if result is not None:
+            return result
+
         vals = self.hop(ents, prop)
         return [max(vals)]
 
     def minimum(self, ents, prop):
+        result = self.aggregate_num_values(ents, prop, np.min)
+        if result is not None:
+            return result
+
         vals = self.hop(ents, prop)
         try:
             result = [min(vals)]
@@ -654,8 +1034,32 @@ class TableExecutor(SimpleKGExecutor):
             raise e
         return result
 
+    def gather_values(self, ents, prop):
+        """Values of `ents` from a single-valued column in the columnar store,
+        in the same order as `self.hop(ents, prop, keep_dup=True)`.
+        Returns `None` if the property is not available or no value is selected."""
+        column = self.get_homogeneous_column(prop, single_valued=True)
+        if column is None:
+            return None
+
+        positions = self.table_store.gather(ents, column)
+        if len(positions) == 0:
+            return None
+
+        if column.kind == 'num':
+            return column.num_values[positions]
+
+        return column.raw_values[positions]
+
     def mode(self, ents, prop):
         """Return the value that appears the most in the prop of the entities."""
+        vals = self.gather_values(ents, prop)
+        if vals is not None:
+            uniq_vals, first_idx, counts = np.unique(vals, return_index=True, return_counts=True)
+            # Ties are listed in the order of their first appearance.
+            max_val_idx = np.sort(first_idx[counts == counts.max()])
+            return vals[max_val_idx].tolist()
+
         vals = self.hop(ents, prop, keep_dup=True)
         count_dict = {}
         for v in vals:
@@ -674,10 +1078,19 @@ class TableExecutor(SimpleKGExecutor):
         return max_val_list
 
     def sum(self, ents, prop):
+        vals = self.gather_values(ents, prop)
+        if vals is not None and vals.dtype == np.float64:
+            # Python's `sum` keeps the results identical to the reference implementation.
+            return [sum(vals.tolist())]
+
         vals = self.hop(ents, prop, keep_dup=True)
         return [sum(vals)]
 
     def average(self, ents, prop):
+        vals = self.gather_values(ents, prop)
+        if vals is not None and vals.dtype == np.float64:
+            return [float(sum(vals.tolist())) / len(vals)]
+
         vals = self.hop(ents, prop, keep_dup=True)
         return [float(sum(vals)) / len(vals)]
 
@@ -707,6 +1120,12 @@ class TableExecutor(SimpleKGExecutor):
         all_rows = namespace['all_rows']['value']
         same_ents = self.filter_equal(all_rows, vals_1, prop)
         # Remove itself.
+        if self.is_row_set(same_ents):
+            row_id = self.table_store.row_index.get(ents[0])
+            if row_id is None or not (same_ents.mask >> row_id) & 1:
+                raise ValueError('list.remove(x): x not in list')
+            return self.table_store.row_set_from_int(same_ents.mask & ~(1 << row_id))
+
         same_ents.remove(ents[0])
         return same_ents
 
@@ -0,0 +1,362 @@
+"""Columnar storage of tables for vectorized execution of table operations."""
+
+import operator
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+
+from nsm.execution.type_system import DateTime
+
+
+class RowSet(list):
+    """An immutable set of rows of a table.
+
+    It is a list of row entities in ascending order, so it can be used
+    wherever an entity list is expected (e.g., when scoring denotations),
+    while `mask` keeps the row indices as an integer bitmask, which makes
+    shifting, intersecting and comparing row sets cheap.
+    """
+
+    __slots__ = ('mask', 'row_mask')
+
+    def __init__(self, rows: List[str], mask: int, row_mask: np.ndarray = None):
+        super(RowSet, self).__init__(rows)
+        self.mask = mask
+        # cached boolean array of the rows, computed by `TableStore.get_row_mask`
+        self.row_mask = row_mask
+
+    def __eq__(self, other):
+        if isinstance(other, RowSet):
+            return self.mask == other.mask
+
+        return list.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return self.__class__, (list(self), self.mask)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('RowSet is immutable')
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+
+
+class Column(object):
+    """Values of a property over all rows of a table, flattened into arrays.
+
+    A cell may hold more than one value, so `row_ids[i]` records the row
+    of the i-th value, and `valid` marks the rows with at least one value.
+    """
+
+    def __init__(self, prop: str, kind: str, row_ids: List[int], raw_values: List[Any], n_rows: int):
+        self.prop = prop
+        self.kind = kind
+        self.row_ids = np.array(row_ids, dtype=np.int64)
+        self.raw_values = np.empty(len(raw_values), dtype=object)
+        self.raw_values[:] = raw_values
+
+        self.valid = np.zeros(n_rows, dtype=bool)
+        self.valid[self.row_ids] = True
+
+        self.is_single_valued = len(set(row_ids)) == len(row_ids)
+        if self.is_single_valued:
+            # position of the value of each row in the flattened arrays, -1 for empty cells
+            self.value_index = np.full(n_rows, -1, dtype=np.int64)
+            self.value_index[self.row_ids] = np.arange(len(row_ids))
+        else:
+            self.value_index = None
+
+        # typed values used by comparisons, `None` if some value cannot be casted
+        self.num_values = None
+        self.years = self.months = self.ordinals = None
+        # raw values are all of the same python type, and can be
+        # aggregated without going back to the python objects
+        self.is_homogeneous = False
+
+        # values casted as in `SimpleKGExecutor.get_cast_func`, `None` if some value cannot be casted
+        casted_values = None
+
+        if kind == 'num':
+            try:
+                casted_values = [float(x) for x in raw_values]
+                self.num_values = np.array(casted_values, dtype=np.float64)
+            except (ValueError, TypeError):
+                pass
+            self.is_homogeneous = (
+                self.num_values is not None and
+                all(type(x) is float for x in raw_values) and
+                not np.isnan(self.num_values).any()
+            )
+        elif kind == 'datetime':
+            try:
+                dates = [DateTime.from_string(x) for x in raw_values]
+            except Exception:
+                dates = None
+
+            if dates is not None:
+                casted_values = dates
+                self.years = np.array([d.year for d in dates], dtype=np.int64)
+                self.months = np.array([d.month for d in dates], dtype=np.int64)
+                self.ordinals = np.array([d._day_repr for d in dates], dtype=np.int64)
+        else:
+            casted_values = raw_values
+            self.is_homogeneous = all(type(x) is str for x in raw_values)
+
+        self.n_values = np.bincount(self.row_ids, minlength=n_rows)
+
+        # inverted index from the set of casted values of a row to the mask of rows
+        # with that set of values, `None` if some value cannot be casted
+        self.equality_index = None
+        if casted_values is not None:
+            try:
+                self.equality_index = self._build_equality_index(casted_values, n_rows)
+            except TypeError:
+                # unhashable values
+                pass
+
+        # substring index from a query string to the mask over values containing it,
+        # filled in lazily since query strings come from the questions.
+        self.substring_index = dict()
+
+        # sorted copies of the typed value arrays (with the positions of the values
+        # in sorted order), used to answer comparisons with binary search.
+        self.sorted_values = dict()
+        if self.num_values is not None and not np.isnan(self.num_values).any():
+            self.sorted_values['num'] = self._sort(self.num_values)
+        elif self.ordinals is not None:
+            self.sorted_values['ordinal'] = self._sort(self.ordinals)
+            self.sorted_values['year'] = self._sort(self.years)
+            self.sorted_values['month'] = self._sort(self.months)
+
+        # sort keys of each row used by `sort_select`, and the rows with a sort key
+        # ordered by the keys, filled in by `TableExecutor.build_sort_index`
+        self.sort_keys = None
+        self.sort_valid = None
+        self.sort_order = None
+
+    def _build_equality_index(self, casted_values: List[Any], n_rows: int) -> Dict[frozenset, np.ndarray]:
+        row_values = [[] for _ in range(n_rows)]
+        for row_id, val in zip(self.row_ids.tolist(), casted_values):
+            row_values[row_id].append(val)
+
+        index = dict()
+        for row_id, vals in enumerate(row_values):
+            key = frozenset(vals)
+            row_mask = index.get(key)
+            if row_mask is None:
+                row_mask = index[key] = np.zeros(n_rows, dtype=bool)
+            row_mask[row_id] = True
+
+        return index
+
+    def get_equal_rows(self, casted_query: frozenset) -> Optional[np.ndarray]:
+        """Mask of the rows whose set of casted values equals `casted_query`,
+        `None` if there is no such row."""
+        return self.equality_index.get(casted_query)
+
+    def get_substring_mask(self, string: str) -> np.ndarray:
+        """Mask over the (string) values that contain `string`."""
+        value_mask = self.substring_index.get(string)
+        if value_mask is None:
+            value_mask = np.fromiter(
+                (string in val for val in self.raw_values),
+                dtype=bool, count=len(self.raw_values))
+            self.substring_index[string] = value_mask
+
+        return value_mask
+
+    @property
+    def is_ordered(self) -> bool:
+        if self.kind == 'num':
+            return self.num_values is not None
+        elif self.kind == 'datetime':
+            return self.ordinals is not None
+
+        return False
+
+    @staticmethod
+    def _sort(values: np.ndarray):
+        order = np.argsort(values, kind='stable')
+
+        return order, values[order]
+
+    # for each comparison operator, the side of `searchsorted` and
+    # whether the matched values are after the insertion point.
+    _SEARCH_SIDES = {
+        operator.ge: ('left', True),
+        operator.gt: ('right', True),
+        operator.le: ('right', False),
+        operator.lt: ('left', False),
+    }
+
+    def compare(self, op, query) -> np.ndarray:
+        """Compare every value of the column with a casted query value,
+        following the semantics of python comparison operators on numbers
+        and `DateTime` objects."""
+        if self.kind == 'num':
+            key, values, query_val = 'num', self.num_values, query
+        elif not isinstance(query, DateTime):
+            return np.zeros(len(self.ordinals), dtype=bool)
+        elif query.is_month_only:
+            key, values, query_val = 'month', self.months, query.month
+        elif query.is_year_only:
+            key, values, query_val = 'year', self.years, query.year
+        else:
+            key, values, query_val = 'ordinal', self.ordinals, query._day_repr
+
+        if key not in self.sorted_values or op not in self._SEARCH_SIDES or query_val != query_val:
+            return op(values, query_val)
+
+        # Binary search for the range of matched values in sorted order.
+        order, sorted_values = self.sorted_values[key]
+        side, after = self._SEARCH_SIDES[op]
+        pos = np.searchsorted(sorted_values, query_val, side=side)
+
+        value_mask = np.zeros(len(values), dtype=bool)
+        value_mask[order[pos:] if after else order[:pos]] = True
+
+        return value_mask
+
+
+class TableStore(object):
+    """Columnar view of a table `kg[row_ent][prop] -> list of values`,
+    built once per table."""
+
+    def __init__(self, table_info: Dict):
+        kg = table_info['kg']
+        self.row_ents = list(table_info['row_ents'])
+        self.n_rows = len(self.row_ents)
+        self.row_index = {ent: i for i, ent in enumerate(self.row_ents)}
+
+        # row entities are stored in the object array to build row sets without copying strings
+        self.row_ent_array = np.empty(self.n_rows, dtype=object)
+        self.row_ent_array[:] = self.row_ents
+        # row sets are only used when row entities are named after their
+        # indices, which is assumed by `next`, `previous`, `first` and `last`.
+        self.supports_row_sets = all(ent == 'row_{}'.format(i) for i, ent in enumerate(self.row_ents))
+        self.full_mask = (1 << self.n_rows) - 1
+
+        num_props = set(table_info['num_props'])
+        datetime_props = set(table_info['datetime_props'])
+
+        row_ids = dict()
+        raw_values = dict()
+        for row_id, ent in enumerate(self.row_ents):
+            for prop, vals in kg.get(ent, {}).items():
+                if not isinstance(vals, list):
+                    raise ValueError('Values of property {} of {} are not a list'.format(prop, ent))
+                row_ids.setdefault(prop, []).extend([row_id] * len(vals))
+                raw_values.setdefault(prop, []).extend(vals)
+
+        self.columns = dict()
+        for prop in raw_values:
+            if prop in datetime_props:
+                kind = 'datetime'
+            elif prop in num_props:
+                kind = 'num'
+            else:
+                kind = 'string'
+
+            self.columns[prop] = Column(prop, kind, row_ids[prop], raw_values[prop], self.n_rows)
+
+    @staticmethod
+    def build(table_info: Dict) -> Optional['TableStore']:
+        """Build the columnar store of a table, or return `None` if
+        the table cannot be represented by rows (e.g., the knowledge
+        graph has non-row entities)."""
+        kg = table_info.get('kg')
+        if not kg or 'row_ents' not in table_info:
+            return None
+
+        row_ents = set(table_info['row_ents'])
+        if any(ent not in row_ents for ent in kg):
+            return None
+
+        try:
+            return TableStore(table_info)
+        except ValueError:
+            return None
+
+    def get_column(self, prop: str) -> Optional[Column]:
+        return self.columns.get(prop)
+
+    def to_row_ids(self, ents: List[str]) -> np.ndarray:
+        """Row index of each entity, -1 for entities not in the table."""
+        row_index = self.row_index
+
+        return np.fromiter(
+            (row_index.get(ent, -1) for ent in ents),
+            dtype=np.int64, count=len(ents))
+
+    def row_set_from_mask(self, row_mask: np.ndarray) -> RowSet:
+        """Build a row set from a boolean array over the rows."""
+        rows = self.row_ent_array[row_mask].tolist()
+        mask = int.from_bytes(np.packbits(row_mask, bitorder='little').tobytes(), 'little')
+
+        return RowSet(rows, mask, row_mask)
+
+    def row_set_from_int(self, mask: int) -> RowSet:
+        """Build a row set from an integer bitmask of row indices."""
+        n_bytes = (self.n_rows + 7) // 8
+        row_mask = np.unpackbits(
+            np.frombuffer(mask.to_bytes(n_bytes, 'little'), dtype=np.uint8),
+            count=self.n_rows, bitorder='little').astype(bool)
+        rows = self.row_ent_array[row_mask].tolist()
+
+        return RowSet(rows, mask, row_mask)
+
+    def make_row_set(self, ents: List[str]) -> Optional[RowSet]:
+        """Convert a list of row entities in ascending order to a row set,
+        or return `None` if the list cannot be represented as a row set."""
+        if not self.supports_row_sets:
+            return None
+
+        ids = self.to_row_ids(ents)
+        if (ids < 0).any() or (len(ids) > 1 and (ids[1:] <= ids[:-1]).any()):
+            return None
+
+        row_mask = np.zeros(self.n_rows, dtype=bool)
+        row_mask[ids] = True
+
+        return self.row_set_from_mask(row_mask)
+
+    def get_row_mask(self, row_set: RowSet) -> np.ndarray:
+        if row_set.row_mask is None:
+            row_set.row_mask = self.row_set_from_int(row_set.mask).row_mask
+
+        return row_set.row_mask
+
+    def is_row_set(self, ents: List[str]) -> bool:
+        return self.supports_row_sets and isinstance(ents, RowSet)
+
+    def select(self, ents: List[str], row_mask: np.ndarray) -> List[str]:
+        """Keep the entities (in their original order) whose rows are set in `row_mask`."""
+        if self.is_row_set(ents):
+            return self.row_set_from_mask(self.get_row_mask(ents) & row_mask)
+
+        ids = self.to_row_ids(ents)
+        keep = (ids >= 0) & row_mask[ids]
+
+        return [ents[i] for i in np.flatnonzero(keep)]
+
+    def value_mask(self, ents: List[str], column: Column) -> np.ndarray:
+        """Mask over the flattened values of `column` belonging to `ents`."""
+        ids = self.to_row_ids(ents)
+        row_mask = np.zeros(self.n_rows, dtype=bool)
+        row_mask[ids[ids >= 0]] = True
+
+        return row_mask[column.row_ids]
+
+    def gather(self, ents: List[str], column: Column) -> np.ndarray:
+        """Positions of the values of `ents` in a single-valued column,
+        following the order (and duplicates) of `ents`."""
+        ids = self.to_row_ids(ents)
+        ids = ids[ids >= 0]
+        positions = column.value_index[ids]
+
+        return positions[positions >= 0]
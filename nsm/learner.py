@@ -25,6 +25,7 @@ from nsm.consistency_utils import ConsistencyModel, QuestionSimilarityModel
 from nsm.retrainer import Retrainer, load_nearest_neighbors
 from nsm.evaluator import Evaluation
 from nsm.program_cache import SharedProgramCache
+from nsm.env_factory import Sample
 
 import torch
 from tensorboardX import SummaryWriter
@@ -63,6 +64,17 @@ class Learner(torch_mp.Process):
         agent_name = self.config.get('parser', 'vanilla')
         self.agent = get_parser_agent_by_name(agent_name).build(self.config, master='learner').to(self.devices[0]).train()
 
+        # actors send compact samples, whose trajectories are recovered from the learner's environments,
+        # which are loaded and tokenized for all the training shards, so this is disabled by default
+        self.environment_dict = None
+        self.trajectory_cache = None
+        # otherwise, trajectories are received without their contexts, which are
+        # sent once per environment and set back from here
+        self.environment_contexts = dict()
+        if self.config.get('compact_train_queue', False):
+            self.load_environments()
+            self.trajectory_cache = dict()
+
         use_trainable_sketch_predictor = self.config.get('use_trainable_sketch_predictor', False)
         if use_trainable_sketch_predictor:
             assert len(self.devices) > 1
@@ -129,7 +141,17 @@ class Learner(torch_mp.Process):
             other_optimizer.zero_grad()
             bert_optimizer.zero_grad()
 
-            train_samples, samples_info = self.train_queue.get()
+            train_samples, samples_info, new_contexts = self.train_queue.get()
+            if self.environment_dict is not None:
+                train_samples = [
+                    Sample.from_compact(sample, self.environment_dict[sample.environment_name],
+                                        trajectory_cache=self.trajectory_cache)
+                    for sample in train_samples
+                ]
+            else:
+                self.environment_contexts.update(new_contexts)
+                for sample in train_samples:
+                    sample.trajectory.context = self.environment_contexts[sample.trajectory.environment_name]
             try:
                 queue_size = self.train_queue.qsize()
                 # print(f'[Learner] train_iter={train_iter} train queue size={queue_size}', file=sys.stderr)
@@ -178,6 +200,10 @@ class Learner(torch_mp.Process):
             if 'clip_frac' in samples_info:
                 summary_writer.add_scalar('sample_clip_frac', samples_info['clip_frac'], train_iter)
 
+            if 'explore_unique_programs_per_second' in samples_info:
+                summary_writer.add_scalar('explore_unique_programs_per_second',
+                                          samples_info['explore_unique_programs_per_second'], train_iter)
+
             # update sketch predictor
             if use_trainable_sketch_predictor:
                 if 'cuda' in self.devices[1].type:
@@ -220,6 +246,22 @@ class Learner(torch_mp.Process):
         #     self.checkpoint_queue.put(STOP_SIGNAL)
         # self.eval_msg_val.value = STOP_SIGNAL.encode()
 
+    def load_environments(self):
+        from table.experiments import load_environments
+
+        train_shard_paths = [
+            os.path.join(self.config['train_shard_dir'], self.config['train_shard_prefix'] + str(i) + '.jsonl')
+            for i in range(self.config['shard_start_id'], self.config['shard_end_id'])
+        ]
+
+        envs = load_environments(train_shard_paths,
+                                 table_file=self.config['table_file'],
+                                 table_representation_method=self.config['table_representation'],
+                                 bert_tokenizer=self.agent.encoder.bert_model.tokenizer,
+                                 use_columnar_store=self.config.get('use_columnar_table_store', False))
+
+        self.environment_dict = {env.name: env for env in envs}
+
     def try_update_model_to_actors(self, train_iter):
         save_every_niter = self.config.get('save_every_niter')
         if train_iter % save_every_niter == 0:
@@ -138,6 +138,31 @@ def masked_log_softmax(vector: torch.Tensor, mask: torch.Tensor, dim: int = -1)
     return torch.nn.functional.log_softmax(vector, dim=dim)
 
 
+def log1mexp(x: torch.Tensor) -> torch.Tensor:
+    """Numerically stable ``log(1 - exp(x))`` for ``x <= 0``."""
+    return torch.where(x > -0.6931, torch.log(-torch.expm1(x)), torch.log1p(-torch.exp(x)))
+
+
+def sample_conditioned_gumbel(log_probs: torch.Tensor, parent_gumbels: torch.Tensor) -> torch.Tensor:
+    """
+    Sample the Gumbel-perturbed log-probabilities of the children of each parent in
+    stochastic beam search (Kool et al., 2019), conditioned on their maximum being
+    the perturbed log-probability of the parent.
+
+    log_probs: (batch_size, child_num), log-probabilities of the children, ``-inf``
+        for invalid children. Each parent must have at least one valid child.
+    parent_gumbels: (batch_size), perturbed log-probabilities of the parents.
+    """
+    uniform = torch.rand_like(log_probs).clamp_(min=1e-20)
+    gumbels = log_probs - torch.log(-torch.log(uniform))
+    max_gumbels = gumbels.max(dim=-1, keepdim=True)[0]
+
+    parent_gumbels = parent_gumbels.unsqueeze(-1)
+    v = parent_gumbels - gumbels + log1mexp(gumbels - max_gumbels)
+
+    return parent_gumbels - v.clamp(min=0.) - torch.log1p(torch.exp(-v.abs()))
+
+
 def get_lengths_from_binary_sequence_mask(mask: torch.Tensor):
     """
     Compute sequence lengths for each batch element in a tensor using a
@@ -1,9 +1,12 @@
 import collections
+import copy
 import math
 import sys
+import time
 from collections import OrderedDict
 from typing import Dict, List
 
+import numpy as np
 import torch
 from torch import nn as nn
 from torch.nn import functional as F
@@ -16,8 +19,9 @@ from nsm.computer_factory import SPECIAL_TKS
 from nsm.env_factory import Trajectory, Observation, Sample, QAProgrammingEnv
 from nsm.parser_module.bert_decoder import BertDecoder
 from nsm.parser_module.bert_encoder import BertEncoder
-from nsm.parser_module.decoder import DecoderBase, Hypothesis, DecoderState
+from nsm.parser_module.decoder import DecoderBase, Hypothesis, DecoderState, DecoderMemory
 from nsm.parser_module.encoder import EncoderBase
+from nsm.sketch.sketch_automaton import SketchAutomaton
 from nsm.sketch.sketch_predictor import SketchPredictor
 
 
@@ -36,6 +40,14 @@ class PGAgent(nn.Module):
         self.encoder = encoder
         self.decoder = decoder
 
+        # optional `ContextEncodingCache` shared by all entry points of the agent,
+        # set by actors which repeatedly encode the same batch of environments
+        self.context_encoding_cache = None
+
+        # optional copy of the encoder with int8 linear layers, used instead of `encoder`
+        # in evaluation mode, see `quantize_encoder`
+        self.quantized_encoder = None
+
     @property
     def memory_size(self):
         return self.decoder.memory_size
@@ -48,12 +60,47 @@ class PGAgent(nn.Module):
     def sufficient_context_encoding_entries(self):
         return ['question_encoding', 'question_mask', 'question_encoding_att_linear']
 
-    def encode(self, env_context):
-        return self.encoder.encode(env_context)
+    def quantize_encoder(self):
+        """
+        Dynamically quantize the linear layers of a copy of the encoder to int8, for
+        inference on CPU. The copy is not registered as a sub-module, so the fp32 encoder
+        still receives the weights given to `load_state_dict`, after which this method
+        should be called again.
+        """
+        if self.device.type != 'cpu':
+            raise RuntimeError(f'dynamic quantization of the encoder is not supported on {self.device}')
+
+        quantized_encoder = torch.quantization.quantize_dynamic(
+            copy.deepcopy(self.encoder).eval(), {nn.Linear}, dtype=torch.qint8)
+
+        object.__setattr__(self, 'quantized_encoder', quantized_encoder)
+
+    def encode(self, env_context, env_names=None):
+        encoder = self.encoder
+        if self.quantized_encoder is not None and not self.training:
+            encoder = self.quantized_encoder
+
+        cache = self.context_encoding_cache
+        if cache is None or env_names is None:
+            return encoder.encode(env_context)
+
+        # only encode environments that are not in the cache
+        uncached_env_context = OrderedDict()
+        for env_name, context in zip(env_names, env_context):
+            if env_name not in cache and env_name not in uncached_env_context:
+                uncached_env_context[env_name] = context
+
+        if uncached_env_context:
+            cache.add(
+                list(uncached_env_context.keys()),
+                encoder.encode(list(uncached_env_context.values()))
+            )
+
+        return cache.get(env_names, new_env_names=list(uncached_env_context.keys()))
 
     def compute_trajectory_actions_prob(self, trajectories: List[Trajectory], return_info=False) -> torch.Tensor:
         contexts = [traj.context for traj in trajectories]
-        context_encoding = self.encoder.encode(contexts)
+        context_encoding = self.encode(contexts, env_names=[traj.environment_name for traj in trajectories])
         state_tm1 = init_state = self.decoder.get_initial_state(context_encoding)
 
         batched_observation_seq, tgt_actions_info = Trajectory.to_batched_sequence_tensors(trajectories,
@@ -154,9 +201,226 @@ class PGAgent(nn.Module):
         return traj_log_prob
 
     def sample(
+        self, environments, sample_num, use_cache=False,
+        constraint_sketches: Dict = None, return_info=False
+    ):
+        if sample_num == 0:
+            return ([], dict()) if return_info else []
+
+        if use_cache:
+            # if already explored everything, then don't explore this environment anymore.
+            environments = [env for env in environments if not env.cache.is_full()]
+
+        if not environments:
+            return ([], dict()) if return_info else []
+
+        sketch_automata = None
+        if constraint_sketches is not None:
+            sketch_automata = self.compile_constraint_sketches(environments, constraint_sketches)
+            environments = [
+                env for env in environments
+                if sketch_automata[env.name].has_allowed_action(sketch_automata[env.name].initial_state,
+                                                                env.start_ob.valid_action_indices)
+            ]
+
+            if not environments:
+                return ([], dict()) if return_info else []
+
+        for env in environments:
+            env.use_cache = use_cache
+
+        # samples of the same environment that share a program prefix are grouped into
+        # a single node of a prefix tree, which carries one environment and the number of
+        # samples passing through it. The decoder is run once per node, and a node only fans
+        # out into child nodes where the actions sampled for its samples diverge.
+        SampleNode = collections.namedtuple('SampleNode', ['env', 'sample_count', 'sketch_state'])
+
+        env_context = [env.get_context() for env in environments]
+        context_encoding = self.encode(env_context, env_names=[env.name for env in environments])
+
+        # nodes are assigned to the rows of the decoder batch. The rows of finished nodes stay in
+        # place and are masked out, and new child nodes are moved into them. The batch is only
+        # compacted when more rows are needed, or when the fraction of active rows drops below
+        # `sample_compaction_threshold`.
+        compaction_threshold = self.config.get('sample_compaction_threshold', 0.5)
+        empty_ob = Observation.empty()
+
+        row_nodes = [
+            SampleNode(
+                env=env.clone(),
+                sample_count=sample_num,
+                sketch_state=sketch_automata[env.name].initial_state if sketch_automata else None
+            )
+            for env in environments
+        ]
+        row_observations = [node.env.start_ob for node in row_nodes]
+        row_log_probs = [0.] * len(row_nodes)
+        completed_nodes = []
+
+        # the context encodings are updated in place, so do not share them with the cache
+        for key in self.sufficient_context_encoding_entries:
+            context_encoding[key] = context_encoding[key].clone()
+
+        state_tm1 = self.decoder.get_initial_state(context_encoding)
+
+        sample_info = dict(steps=0, decoder_time=0., compaction_time=0., compaction_num=0,
+                           decoder_row_num=0, active_row_num=0)
+        memory_allocation_stats = DecoderMemory.get_allocation_stats()
+
+        while True:
+            t1 = time.time()
+            batched_ob_tm1 = Observation.to_batched_input(row_observations, memory_size=self.memory_size).to(
+                self.device)
+            mem_logits, state_t = self.decoder.step(batched_ob_tm1, state_tm1, context_encoding=context_encoding)
+            t2 = time.time()
+
+            active_rows = [row for row, node in enumerate(row_nodes) if node is not None]
+
+            sample_info['steps'] += 1
+            sample_info['decoder_time'] += t2 - t1
+            sample_info['decoder_row_num'] += len(row_nodes)
+            sample_info['active_row_num'] += len(active_rows)
+
+            valid_action_mask = batched_ob_tm1.valid_action_mask
+            if len(active_rows) < len(row_nodes):
+                mem_logits = mem_logits[active_rows]
+                valid_action_mask = valid_action_mask[active_rows]
+
+            mem_logits.masked_fill_((1 - valid_action_mask).bool(), -math.inf)
+            if sketch_automata is not None:
+                sketch_action_mask = self.get_sketch_allowed_action_mask([
+                    (sketch_automata[row_nodes[row].env.name], row_nodes[row].sketch_state)
+                    for row in active_rows
+                ])
+                mem_logits.masked_fill_(~sketch_action_mask.to(self.device), -math.inf)
+
+            # (active_row_num, memory_size)
+            action_log_probs = torch.log_softmax(mem_logits, dim=-1)
+
+            # draw the actions of all samples of each node, and keep the first
+            # `sample_count` ones of each node
+            max_sample_count = max(row_nodes[row].sample_count for row in active_rows)
+            # (active_row_num, max_sample_count)
+            sampled_action_ids = torch.multinomial(action_log_probs.exp(), num_samples=max_sample_count,
+                                                   replacement=True)
+            # (active_row_num, memory_size)
+            node_log_probs_tm1 = torch.tensor([row_log_probs[row] for row in active_rows], device=self.device)
+            candidate_log_probs = (node_log_probs_tm1.unsqueeze(-1) + action_log_probs).tolist()
+            sampled_action_ids = sampled_action_ids.tolist()
+
+            # the first child of a node takes over the row of the node, and the
+            # other ones are moved to new rows
+            kept_rows = []
+            new_row_children = []
+            for active_row_id, row in enumerate(active_rows):
+                node = row_nodes[row]
+                action_sample_counts = collections.Counter(sampled_action_ids[active_row_id][:node.sample_count])
+
+                row_nodes[row] = None
+                row_observations[row] = empty_ob
+
+                for action_t, sample_count in action_sample_counts.items():
+                    # a node with a single child hands its environment over to the child
+                    if len(action_sample_counts) == 1:
+                        env = node.env
+                    else:
+                        env = node.env.clone()
+
+                    action_rel_id = env.valid_actions.index(action_t)
+                    ob_t, _, _, info = env.step(action_rel_id)
+
+                    child_sketch_state = None
+                    if sketch_automata is not None:
+                        child_sketch_state = sketch_automata[env.name].step(node.sketch_state, action_t)
+
+                    child_node = SampleNode(env=env, sample_count=sample_count, sketch_state=child_sketch_state)
+                    child_log_prob = candidate_log_probs[active_row_id][action_t]
+                    if env.done:
+                        completed_nodes.append((child_node, child_log_prob))
+                    else:
+                        has_valid_action = bool(ob_t.valid_action_indices)
+                        if sketch_automata is not None:
+                            has_valid_action = sketch_automata[env.name].has_allowed_action(
+                                child_sketch_state, ob_t.valid_action_indices)
+
+                        if not has_valid_action:
+                            continue
+
+                        if row_nodes[row] is None:
+                            row_nodes[row] = child_node
+                            row_observations[row] = ob_t
+                            row_log_probs[row] = child_log_prob
+                            kept_rows.append(row)
+                        else:
+                            new_row_children.append((row, child_node, ob_t, child_log_prob))
+
+            if not kept_rows:
+                break
+
+            t1 = time.time()
+            free_rows = [row for row, node in enumerate(row_nodes) if node is None]
+            active_row_num = len(kept_rows) + len(new_row_children)
+
+            if len(new_row_children) > len(free_rows) or active_row_num < compaction_threshold * len(row_nodes):
+                # compact the batch, and append the rows of the new child nodes
+                row_index = kept_rows + [parent_row for parent_row, *_ in new_row_children]
+
+                for key in self.sufficient_context_encoding_entries:
+                    context_encoding[key] = context_encoding[key][row_index]
+
+                state_t = state_t[row_index]
+
+                row_nodes = [row_nodes[row] for row in kept_rows] + [
+                    child_node for _, child_node, _, _ in new_row_children]
+                row_observations = [row_observations[row] for row in kept_rows] + [
+                    ob_t for _, _, ob_t, _ in new_row_children]
+                row_log_probs = [row_log_probs[row] for row in kept_rows] + [
+                    child_log_prob for _, _, _, child_log_prob in new_row_children]
+
+                sample_info['compaction_num'] += 1
+            elif new_row_children:
+                # copy the decoder states and context encodings of the parent nodes to the free rows
+                child_rows = free_rows[:len(new_row_children)]
+                parent_rows = [parent_row for parent_row, *_ in new_row_children]
+
+                for key in self.sufficient_context_encoding_entries:
+                    context_encoding[key][child_rows] = context_encoding[key][parent_rows]
+
+                state_t[child_rows] = state_t[parent_rows]
+
+                for row, (_, child_node, ob_t, child_log_prob) in zip(child_rows, new_row_children):
+                    row_nodes[row] = child_node
+                    row_observations[row] = ob_t
+                    row_log_probs[row] = child_log_prob
+
+            sample_info['compaction_time'] += time.time() - t1
+
+            state_tm1 = state_t
+
+        samples = []
+        for node, prob in completed_nodes:
+            if not node.env.error:
+                traj = Trajectory.from_environment(node.env)
+                samples.extend(Sample(trajectory=traj, prob=prob) for _ in range(node.sample_count))
+
+        if return_info:
+            for key, val in DecoderMemory.get_allocation_stats().items():
+                sample_info[f'memory_{key}'] = val - memory_allocation_stats[key]
+
+            return samples, sample_info
+
+        return samples
+
+    def sample_without_replacement(
         self, environments, sample_num, use_cache=False,
         constraint_sketches: Dict = None,
     ):
+        """
+        Sample `sample_num` distinct programs for each environment in a single batched
+        pass with stochastic beam search (Kool et al., 2019), i.e., a beam search over
+        Gumbel-perturbed log-probabilities, which gives a sample without replacement
+        of the programs. The `prob` of each sample is its log-probability.
+        """
         if sample_num == 0:
             return []
 
@@ -164,109 +428,158 @@ class PGAgent(nn.Module):
             # if already explored everything, then don't explore this environment anymore.
             environments = [env for env in environments if not env.cache.is_full()]
 
-        duplicated_envs = []
-        for env in environments:
-            for i in range(sample_num):
-                duplicated_envs.append(env.clone())
+        if not environments:
+            return []
 
-        environments = duplicated_envs
         for env in environments:
             env.use_cache = use_cache
 
-        completed_envs = []
-        active_envs = environments
+        sketch_automata = None
+        if constraint_sketches is not None:
+            sketch_automata = self.compile_constraint_sketches(environments, constraint_sketches)
+
+        # `score` is the log-probability of the (partial) program, and `gumbel` its perturbed
+        # log-probability, by which the hypotheses are ranked
+        SampleHyp = collections.namedtuple('SampleHyp', ['env', 'score', 'gumbel'])
+        CandidateHyp = collections.namedtuple('CandidateHyp',
+                                              ['prev_hyp_env', 'action_id', 'score', 'gumbel', 'prev_hyp_abs_pos'])
+
+        beams = OrderedDict((env.name, [SampleHyp(env=env, score=0., gumbel=0.)]) for env in environments)
+        completed_hyps = OrderedDict((env.name, []) for env in environments)
 
         env_context = [env.get_context() for env in environments]
-        context_encoding = self.encode(env_context)
+        context_encoding = self.encode(env_context, env_names=[env.name for env in environments])
 
         observations_tm1 = [env.start_ob for env in environments]
         state_tm1 = self.decoder.get_initial_state(context_encoding)
-        sample_probs = torch.zeros(len(environments), device=self.device)
+        hyp_scores_tm1 = torch.zeros(len(environments), device=self.device)
+        hyp_gumbels_tm1 = torch.zeros(len(environments), device=self.device)
 
-        while True:
+        while beams:
             batched_ob_tm1 = Observation.to_batched_input(observations_tm1, memory_size=self.memory_size).to(
                 self.device)
-            mem_logits, state_t = self.decoder.step(observations_tm1, state_tm1, context_encoding=context_encoding)
-
-            # try:
-            # (batch_size)
-            sampled_action_t_id, sampled_action_t_prob = self.sample_action(mem_logits,
-                                                                            batched_ob_tm1.valid_action_mask,
-                                                                            return_log_prob=True)
-            # except RuntimeError:
-            #     for ob in observations_tm1:
-            #         print(f'Observation {ob}', file=sys.stderr)
-            #         print(ob.valid_action_indices, file=sys.stderr)
-            #
-            #     print(batched_ob_tm1.valid_action_mask, file=sys.stderr)
-            #     torch.save((mem_logits, batched_ob_tm1.valid_action_mask), 'tmp.bin')
-            #     exit(-1)
-
-            sample_probs = sample_probs + sampled_action_t_prob
-
-            # print(sample_probs)
 
+            # (hyp_num, memory_size)
+            action_probs_t, state_t = self.decoder.step_and_get_action_scores_t(batched_ob_tm1, state_tm1,
+                                                                                context_encoding=context_encoding)
+            action_probs_t[(1 - batched_ob_tm1.valid_action_mask).bool()] = float('-inf')
+
+            if sketch_automata is not None:
+                action_probs_t = action_probs_t.masked_fill(
+                    ~self.get_sketch_compatible_action_mask(beams, sketch_automata).to(self.device),
+                    float('-inf')
+                )
+
+            # (hyp_num, memory_size)
+            cont_cand_hyp_scores = action_probs_t + hyp_scores_tm1.unsqueeze(-1)
+            cont_cand_hyp_gumbels = nn_util.sample_conditioned_gumbel(cont_cand_hyp_scores, hyp_gumbels_tm1)
+
+            # hypotheses whose actions are all incompatible with the sketches are dropped
+            cont_cand_hyp_gumbels.masked_fill_(torch.isnan(cont_cand_hyp_gumbels), float('-inf'))
+
+            # per-environment top-k selection over the perturbed log-probabilities
+            hyp_env_ids = []
+            hyp_beam_pos = []
+            for env_idx, beam in enumerate(beams.values()):
+                hyp_env_ids.extend([env_idx] * len(beam))
+                hyp_beam_pos.extend(range(len(beam)))
+
+            max_live_beam_size = max(len(beam) for beam in beams.values())
+            env_cand_gumbels = cont_cand_hyp_gumbels.new_full(
+                (len(beams), max_live_beam_size, self.memory_size), float('-inf'))
+            env_cand_gumbels[hyp_env_ids, hyp_beam_pos] = cont_cand_hyp_gumbels
+            env_cand_gumbels = env_cand_gumbels.view(len(beams), -1)
+
+            env_cand_scores = cont_cand_hyp_scores.new_full(
+                (len(beams), max_live_beam_size, self.memory_size), float('-inf'))
+            env_cand_scores[hyp_env_ids, hyp_beam_pos] = cont_cand_hyp_scores
+            env_cand_scores = env_cand_scores.view(len(beams), -1)
+
+            top_cand_gumbels, top_cand_pos = torch.topk(
+                env_cand_gumbels, k=min(sample_num, env_cand_gumbels.size(-1)), dim=-1)
+            top_cand_scores = torch.gather(env_cand_scores, -1, top_cand_pos).tolist()
+            top_cand_gumbels = top_cand_gumbels.tolist()
+            top_cand_pos = top_cand_pos.tolist()
+
+            beam_start = 0
+            new_beams = OrderedDict()
             observations_t = []
-            new_active_env_pos = []
-            new_active_envs = []
-            has_completed_sample = False
-            for env_id, (env, action_t) in enumerate(zip(active_envs, sampled_action_t_id.tolist())):
-                action_rel_id = env.valid_actions.index(action_t)
-                ob_t, _, _, info = env.step(action_rel_id)
-                if env.done:
-                    completed_envs.append((env, sample_probs[env_id].item()))
-                    has_completed_sample = True
-                else:
-                    if constraint_sketches is not None:
-                        # filtered_valid_action_ids = set()
-                        valid_sketches = constraint_sketches[env.name]
-                        for valid_action_id in list(env.valid_actions):
-                            action_token_t = env.de_vocab.lookup(valid_action_id, reverse=True)
-                            hyp_partial_program = env.program + [action_token_t]
-                            is_compatible = any(
-                                sketch.is_compatible_with_program(hyp_partial_program)
-                                for sketch
-                                in valid_sketches
-                            )
-
-                            if not is_compatible:
-                                ob_t.remove_action(valid_action_id)
-
-                    if ob_t.valid_action_indices:
-                        observations_t.append(ob_t)
-                        new_active_env_pos.append(env_id)
-                        new_active_envs.append(env)
+            new_hyp_parent_abs_pos_list = []
+            new_hyp_scores = []
+            new_hyp_gumbels = []
+            for env_idx, (env_name, beam) in enumerate(beams.items()):
+                candidates = []
+                for gumbel, score, cand_pos in zip(top_cand_gumbels[env_idx], top_cand_scores[env_idx],
+                                                   top_cand_pos[env_idx]):
+                    # candidates are sorted, the remaining ones are all invalid
+                    if math.isinf(gumbel):
+                        break
+
+                    prev_hyp_id, abs_action_id = divmod(cand_pos, self.memory_size)
+                    candidates.append(CandidateHyp(
+                        prev_hyp_env=beam[prev_hyp_id].env,
+                        action_id=abs_action_id,
+                        score=score,
+                        gumbel=gumbel,
+                        prev_hyp_abs_pos=beam_start + prev_hyp_id
+                    ))
+
+                # completed hypotheses stay in the beam, ranked together with the continuing ones
+                all_candidates = completed_hyps[env_name] + candidates
+                all_candidates.sort(key=lambda hyp: hyp.gumbel, reverse=True)
+
+                completed_hyps[env_name] = []
+                for cand_hyp in all_candidates[:sample_num]:
+                    if isinstance(cand_hyp, SampleHyp):
+                        completed_hyps[env_name].append(cand_hyp)
+                        continue
+
+                    new_hyp_env = cand_hyp.prev_hyp_env.clone()
+                    rel_action_id = new_hyp_env.valid_actions.index(cand_hyp.action_id)
+                    ob_t, _, _, info = new_hyp_env.step(rel_action_id)
+
+                    new_hyp = SampleHyp(env=new_hyp_env, score=cand_hyp.score, gumbel=cand_hyp.gumbel)
+                    if new_hyp_env.done:
+                        if not new_hyp_env.error:
+                            completed_hyps[env_name].append(new_hyp)
                     else:
-                        # force recomputing source context encodings since this environment
-                        # is finished
-                        has_completed_sample = True
+                        new_beams.setdefault(env_name, []).append(new_hyp)
 
-            if not new_active_env_pos:
-                break
+                        new_hyp_parent_abs_pos_list.append(cand_hyp.prev_hyp_abs_pos)
+                        observations_t.append(ob_t)
+                        new_hyp_scores.append(cand_hyp.score)
+                        new_hyp_gumbels.append(cand_hyp.gumbel)
 
-            if has_completed_sample:
-                # need to perform slicing
-                for key in self.sufficient_context_encoding_entries:
-                    context_encoding[key] = context_encoding[key][new_active_env_pos]
+                beam_start += len(beam)
 
-                state_tm1 = state_t[new_active_env_pos]
-                sample_probs = sample_probs[new_active_env_pos]
-            else:
-                state_tm1 = state_t
+            if not new_beams:
+                break
 
+            state_tm1 = state_t.branch(new_hyp_parent_abs_pos_list)
             observations_tm1 = observations_t
-            active_envs = new_active_envs
+            hyp_scores_tm1 = torch.tensor(new_hyp_scores, device=self.device)
+            hyp_gumbels_tm1 = torch.tensor(new_hyp_gumbels, device=self.device)
+
+            for key in self.sufficient_context_encoding_entries:
+                context_encoding[key] = context_encoding[key][new_hyp_parent_abs_pos_list]
+
+            beams = new_beams
 
         samples = []
-        for env_id, (env, prob) in enumerate(completed_envs):
-            if not env.error:
-                traj = Trajectory.from_environment(env)
-                samples.append(Sample(trajectory=traj, prob=prob))
+        for env_name, hyps in completed_hyps.items():
+            for hyp in hyps:
+                traj = Trajectory.from_environment(hyp.env)
+                samples.append(Sample(trajectory=traj, prob=hyp.score))
 
         return samples
 
     def new_beam_search(self, environments, beam_size, use_cache=False, return_list=False,
-                        constraint_sketches=None, strict_constraint_on_sketches=False, force_sketch_coverage=False):
+                        constraint_sketches=None, strict_constraint_on_sketches=False, force_sketch_coverage=False,
+                        max_decode_steps: int = None):
+        """
+        Batched beam search. The search stops after `max_decode_steps` decoding steps if given,
+        discarding the hypotheses that are still live.
+        """
         if strict_constraint_on_sketches or force_sketch_coverage:
             assert constraint_sketches is not None
 
@@ -275,12 +588,28 @@ class PGAgent(nn.Module):
             # if already explored everything, then don't explore this environment anymore.
             environments = [env for env in environments if not env.cache.is_full()]
 
+        if not environments:
+            return [] if return_list else OrderedDict()
+
         for env in environments:
             env.use_cache = use_cache
 
+        sketch_automata = None
+        if strict_constraint_on_sketches or force_sketch_coverage:
+            sketch_automata = self.compile_constraint_sketches(environments, constraint_sketches)
+
+        def _get_compatible_sketches(_hyp):
+            if isinstance(_hyp, Hypothesis):
+                _automaton = sketch_automata[_hyp.env.name]
+                _sketch_state = _automaton.get_state(_hyp.env.mapped_actions)
+            else:
+                _automaton = sketch_automata[_hyp.prev_hyp_env.name]
+                _sketch_state = _automaton.step(_automaton.get_state(_hyp.prev_hyp_env.mapped_actions), _hyp.action_id)
+
+            return _automaton.get_compatible_sketches(_sketch_state)
+
         CandidateHyp = collections.namedtuple('CandidateHyp',
-                                              ['prev_hyp_env', 'action_id', 'rel_action_id', 'score',
-                                               'prev_hyp_abs_pos'])
+                                              ['prev_hyp_env', 'action_id', 'score', 'prev_hyp_abs_pos'])
 
         batch_size = len(environments)
         # max_live_hyp_num = 1
@@ -292,22 +621,30 @@ class PGAgent(nn.Module):
 
         # (env_num, ...)
         env_context = [env.get_context() for env in environments]
-        context_encoding_expanded = context_encoding = self.encode(env_context)
+        context_encoding_expanded = context_encoding = self.encode(
+            env_context, env_names=[env.name for env in environments])
 
         observations_tm1 = [env.start_ob for env in environments]
         state_tm1 = self.decoder.get_initial_state(context_encoding)
         hyp_scores_tm1 = torch.zeros(batch_size, device=self.device)
 
-        # collect input tables for each example
+        # collect input tables and decoding statistics for each example
         env_logging_info = {
             env.name: {
-                'input_table': context_encoding['table_bert_encoding']['input_tables'][env_idx]
+                'input_table': context_encoding['table_bert_encoding']['input_tables'][env_idx],
+                'decode_steps': 0,
+                'reached_max_decode_steps': False
             }
             for env_idx, env
             in enumerate(environments)
         }
 
+        t = 0
         while beams:
+            t += 1
+            for env_name in beams:
+                env_logging_info[env_name]['decode_steps'] += 1
+
             batched_ob_tm1 = Observation.to_batched_input(observations_tm1, memory_size=self.memory_size).to(
                 self.device)
 
@@ -318,7 +655,37 @@ class PGAgent(nn.Module):
 
             # (hyp_num, memory_size)
             cont_cand_hyp_scores = action_probs_t + hyp_scores_tm1.unsqueeze(-1)
-            cont_cand_hyp_scores = cont_cand_hyp_scores
+
+            if strict_constraint_on_sketches:
+                cont_cand_hyp_scores = cont_cand_hyp_scores.masked_fill(
+                    ~self.get_sketch_compatible_action_mask(beams, sketch_automata).to(self.device),
+                    float('-inf')
+                )
+
+            # gather candidate scores of each environment into a padded
+            # tensor of shape (env_num, max_live_beam_size * memory_size),
+            # and perform per-environment top-k selection over it
+            hyp_env_ids = []
+            hyp_beam_pos = []
+            for env_idx, beam in enumerate(beams.values()):
+                hyp_env_ids.extend([env_idx] * len(beam))
+                hyp_beam_pos.extend(range(len(beam)))
+
+            max_live_beam_size = max(len(beam) for beam in beams.values())
+            env_cand_scores = cont_cand_hyp_scores.new_full(
+                (len(beams), max_live_beam_size, self.memory_size), float('-inf'))
+            env_cand_scores[hyp_env_ids, hyp_beam_pos] = cont_cand_hyp_scores
+            env_cand_scores = env_cand_scores.view(len(beams), -1)
+
+            if force_sketch_coverage:
+                # candidates outside of the top-k could still be used to cover sketches
+                top_cand_scores, top_cand_pos = torch.sort(env_cand_scores, dim=-1, descending=True)
+            else:
+                top_cand_scores, top_cand_pos = torch.topk(
+                    env_cand_scores, k=min(beam_size, env_cand_scores.size(-1)), dim=-1)
+
+            top_cand_scores = top_cand_scores.tolist()
+            top_cand_pos = top_cand_pos.tolist()
 
             # collect hypotheses
             beam_start = 0
@@ -328,39 +695,25 @@ class PGAgent(nn.Module):
             observations_t = []
             new_hyp_parent_abs_pos_list = []
             new_hyp_scores = []
-            for env_name, beam in beams.items():
+            for env_idx, (env_name, beam) in enumerate(beams.items()):
                 live_beam_size = len(beam)
                 beam_end = beam_start + live_beam_size
-                # (beam_size, memory_size)
-                beam_new_cont_scores = cont_cand_hyp_scores[beam_start: beam_end]
                 continuing_candidates[env_name] = []
 
-                for prev_hyp_id, prev_hyp in enumerate(beam):
-                    _cont_action_scores = beam_new_cont_scores[prev_hyp_id][
-                        prev_hyp.env.obs[-1].valid_action_indices].cpu()
-                    for rel_action_id, new_hyp_score in enumerate(_cont_action_scores):
-                        abs_action_id = prev_hyp.env.obs[-1].valid_action_indices[rel_action_id]
-                        new_hyp_score = new_hyp_score.item()
-                        if not math.isinf(new_hyp_score):
-                            candidate_hyp = CandidateHyp(
-                                prev_hyp_env=prev_hyp.env,
-                                rel_action_id=rel_action_id,
-                                action_id=abs_action_id,
-                                score=new_hyp_score,
-                                prev_hyp_abs_pos=beam_start + prev_hyp_id
-                            )
-
-                            if strict_constraint_on_sketches:
-                                is_compatible = any(
-                                    sketch.is_compatible_with_hypothesis(candidate_hyp)
-                                    for sketch
-                                    in constraint_sketches[env_name]
-                                )
-                            else:
-                                is_compatible = True
-
-                            if is_compatible:
-                                continuing_candidates[env_name].append(candidate_hyp)
+                for new_hyp_score, cand_pos in zip(top_cand_scores[env_idx], top_cand_pos[env_idx]):
+                    # candidates are sorted, the remaining ones are all invalid
+                    if math.isinf(new_hyp_score):
+                        break
+
+                    prev_hyp_id, abs_action_id = divmod(cand_pos, self.memory_size)
+                    candidate_hyp = CandidateHyp(
+                        prev_hyp_env=beam[prev_hyp_id].env,
+                        action_id=abs_action_id,
+                        score=new_hyp_score,
+                        prev_hyp_abs_pos=beam_start + prev_hyp_id
+                    )
+
+                    continuing_candidates[env_name].append(candidate_hyp)
 
                 # rank all hypotheses together with completed ones
                 all_candidates = completed_hyps[env_name] + continuing_candidates[env_name]
@@ -375,7 +728,8 @@ class PGAgent(nn.Module):
                     else:
                         new_hyp_env = _hyp.prev_hyp_env.clone()
 
-                        ob_t, _, _, info = new_hyp_env.step(_hyp.rel_action_id)
+                        rel_action_id = new_hyp_env.valid_actions.index(_hyp.action_id)
+                        ob_t, _, _, info = new_hyp_env.step(rel_action_id)
 
                         if new_hyp_env.done:
                             if not new_hyp_env.error:
@@ -398,20 +752,12 @@ class PGAgent(nn.Module):
                         _add_hypothesis_to_new_beam(cand_hyp)
 
                         if force_sketch_coverage:
-                            cand_hyp_covered_sketches = set(
-                                sketch
-                                for sketch
-                                in env_new_beam_not_covered_sketches
-                                if sketch.is_compatible_with_hypothesis(cand_hyp))
-                            env_new_beam_not_covered_sketches -= cand_hyp_covered_sketches
+                            env_new_beam_not_covered_sketches.difference_update(_get_compatible_sketches(cand_hyp))
 
                     # make sure each sketch has at least one candidate hypothesis in the new beam
                     elif force_sketch_coverage and env_new_beam_not_covered_sketches:
-                        cand_hyp_covered_sketches = set(
-                            sketch
-                            for sketch
-                            in env_new_beam_not_covered_sketches
-                            if sketch.is_compatible_with_hypothesis(cand_hyp))
+                        cand_hyp_covered_sketches = env_new_beam_not_covered_sketches.intersection(
+                            _get_compatible_sketches(cand_hyp))
 
                         if cand_hyp_covered_sketches:
                             _add_hypothesis_to_new_beam(cand_hyp)
@@ -444,11 +790,13 @@ class PGAgent(nn.Module):
             if len(new_beams) == 0:
                 break
 
-            new_hyp_state_t = [(s[0][new_hyp_parent_abs_pos_list], s[1][new_hyp_parent_abs_pos_list]) for s in
-                               state_t.state]
-            new_hyp_memory_t = state_t.memory[new_hyp_parent_abs_pos_list]
+            if max_decode_steps is not None and t >= max_decode_steps:
+                for env_name in new_beams:
+                    env_logging_info[env_name]['reached_max_decode_steps'] = True
+
+                break
 
-            state_tm1 = DecoderState(state=new_hyp_state_t, memory=new_hyp_memory_t)
+            state_tm1 = state_t.branch(new_hyp_parent_abs_pos_list)
             observations_tm1 = observations_t
             hyp_scores_tm1 = torch.tensor(new_hyp_scores, device=self.device)
 
@@ -457,6 +805,10 @@ class PGAgent(nn.Module):
 
             beams = new_beams
 
+        # decoding steps run for the whole batch
+        for env_name in env_logging_info:
+            env_logging_info[env_name]['batch_decode_steps'] = t
+
         if not return_list:
             # rank completed hypothesis
             for env_name in completed_hyps.keys():
@@ -484,15 +836,48 @@ class PGAgent(nn.Module):
 
             return samples_list
 
+    def compile_constraint_sketches(self, environments, constraint_sketches: Dict) -> Dict[str, SketchAutomaton]:
+        """Compile the constraint sketches of each environment into an automaton over its action ids"""
+        return {
+            env.name: SketchAutomaton(constraint_sketches[env.name], env.de_vocab, self.memory_size)
+            for env in environments
+        }
+
+    def get_sketch_allowed_action_mask(self, automaton_states: List) -> torch.Tensor:
+        """
+        Returns a (hyp_num, memory_size) boolean mask of the actions allowed in each
+        of the given (sketch automaton, state) pairs.
+        """
+        return torch.from_numpy(np.stack([
+            automaton.get_allowed_action_mask(state)
+            for automaton, state
+            in automaton_states
+        ]))
+
+    def get_sketch_compatible_action_mask(self, beams, sketch_automata: Dict[str, SketchAutomaton]) -> torch.Tensor:
+        """
+        Returns a (hyp_num, memory_size) boolean mask of the actions of each live hypothesis
+        in `beams` that are compatible with any constraint sketch of its environment.
+        """
+        return self.get_sketch_allowed_action_mask([
+            (sketch_automata[env_name], sketch_automata[env_name].get_state(hyp.env.mapped_actions))
+            for env_name, beam in beams.items()
+            for hyp in beam
+        ])
+
     def decode_examples(self, environments: List[QAProgrammingEnv], beam_size, batch_size=32):
         decode_results = []
         use_sketch_constrained_decoding = self.config.get('use_sketch_constrained_decoding', False)
+        max_decode_steps = self.config.get('max_decode_steps', None)
 
         if use_sketch_constrained_decoding:
             assert self.sketch_manager is not None
             print('[Model] use sketch-constrained decoding...', file=sys.stderr)
             num_sketch = self.config.get('sketch_constrained_decoding_num_sketch', 5)
 
+        DecoderMemory.reset_allocation_stats()
+        batch_decode_steps = []
+
         with torch.no_grad():
             batch_iter = nn_util.batch_iter(environments, batch_size, shuffle=False)
             for batched_envs in tqdm(batch_iter, total=len(environments) // batch_size, file=sys.stdout):
@@ -512,12 +897,48 @@ class PGAgent(nn.Module):
                     batched_envs,
                     beam_size=beam_size,
                     constraint_sketches=constraint_sketches,
-                    strict_constraint_on_sketches=use_sketch_constrained_decoding
+                    strict_constraint_on_sketches=use_sketch_constrained_decoding,
+                    max_decode_steps=max_decode_steps
                 )
 
                 batch_decode_result = list(batch_decode_result.values())
                 decode_results.extend(batch_decode_result)
 
+                batch_logging_info = [
+                    hyps[0].logging_info
+                    for hyps in batch_decode_result
+                    if hyps and 'batch_decode_steps' in getattr(hyps[0], 'logging_info', {})
+                ]
+                if batch_logging_info:
+                    batch_decode_steps.append(batch_logging_info[0]['batch_decode_steps'])
+
+        decode_logging_info = [
+            hyps[0].logging_info
+            for hyps in decode_results
+            if hyps and 'decode_steps' in getattr(hyps[0], 'logging_info', {})
+        ]
+        if decode_logging_info:
+            print(
+                f'[Model] average decode steps {np.mean([info["decode_steps"] for info in decode_logging_info]):.2f}, '
+                f'{sum(info["reached_max_decode_steps"] for info in decode_logging_info)} examples '
+                f'reached the max decode steps',
+                file=sys.stderr
+            )
+
+        if max_decode_steps is not None and batch_decode_steps:
+            print(
+                f'[Model] average decode steps saved per batch by the budget of {max_decode_steps} steps: '
+                f'{np.mean([max_decode_steps - steps for steps in batch_decode_steps]):.2f}',
+                file=sys.stderr
+            )
+
+        memory_allocation_stats = DecoderMemory.get_allocation_stats()
+        print(
+            f'[Model] allocated {memory_allocation_stats["allocation_num"]} decoder memory buffers '
+            f'({memory_allocation_stats["allocated_bytes"] / 2 ** 20:.1f}MB)',
+            file=sys.stderr
+        )
+
         return decode_results
 
     def sample_action(self, logits, valid_action_mask, return_log_prob=False):
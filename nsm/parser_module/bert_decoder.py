@@ -1,3 +1,4 @@
+import functools
 import itertools
 from typing import Union, List, Dict, Tuple
 
@@ -9,7 +10,47 @@ from nsm import nn_util
 from nsm.parser_module.encoder import ContextEncoding
 from nsm.env_factory import Observation
 from nsm.parser_module.bert_encoder import BertEncoder
-from nsm.parser_module.decoder import DecoderBase, MultiLayerDropoutLSTMCell, DecoderState
+from nsm.parser_module.decoder import (
+    DecoderBase, MultiLayerDropoutLSTMCell, DecoderState, DecoderMemory, multi_layer_lstm_cell
+)
+
+
+def lstm_attention_step(
+    input_mem_entry: torch.Tensor,
+    state_tm1: List[Tuple[torch.Tensor, torch.Tensor]],
+    cell_weights: List[List[torch.Tensor]],
+    dropout: float,
+    training: bool,
+    use_skip_connection: bool,
+    question_encoding: torch.Tensor,
+    question_encoding_att_linear: torch.Tensor,
+    question_mask: torch.Tensor,
+    att_vec_weight: torch.Tensor
+) -> Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor]]]:
+    """
+    The recurrent cells and the attention over the question of `BertDecoder.step`,
+    written as a function of the weights of the decoder to be compiled by TorchScript.
+    """
+    # (batch_size, hidden_size)
+    inner_output_t, inner_state_t = multi_layer_lstm_cell(
+        input_mem_entry, state_tm1, cell_weights, dropout, training, use_skip_connection)
+
+    # (batch_size, src_sent_len)
+    att_weight = torch.bmm(question_encoding_att_linear, inner_output_t.unsqueeze(2)).squeeze(2)
+    att_weight = att_weight.masked_fill((1.0 - question_mask) != 0, -float('inf'))
+    att_prob = torch.softmax(att_weight, dim=-1)
+
+    # (batch_size, hidden_size)
+    ctx_t = torch.bmm(att_prob.unsqueeze(1), question_encoding).squeeze(1)
+
+    att_t = torch.tanh(F.linear(torch.cat([inner_output_t, ctx_t], 1), att_vec_weight))
+
+    return att_t, inner_state_t
+
+
+@functools.lru_cache(maxsize=None)
+def get_scripted_lstm_attention_step():
+    return torch.jit.script(lstm_attention_step)
 
 
 class BertDecoder(DecoderBase):
@@ -25,6 +66,7 @@ class BertDecoder(DecoderBase):
         memory_size: int,
         encoder: BertEncoder,
         dropout=0.,
+        use_scripted_step=False,
         **kwargs
     ):
         DecoderBase.__init__(
@@ -61,6 +103,9 @@ class BertDecoder(DecoderBase):
 
         self.dropout = nn.Dropout(dropout)
 
+        # use the TorchScript version of the recurrent cells and the attention in `step`
+        self.use_scripted_step = use_scripted_step
+
         self.init_weights()
 
     def init_weights(self):
@@ -99,6 +144,7 @@ class BertDecoder(DecoderBase):
             memory_size=config['memory_size'],
             encoder=encoder,
             dropout=config['dropout'],
+            use_scripted_step=config.get('use_scripted_decoder_step', False)
         )
 
     def get_lstm_init_state(self, context_encoding: ContextEncoding):
@@ -119,7 +165,7 @@ class BertDecoder(DecoderBase):
 
         decoder_init_states = self.get_lstm_init_state(context_encoding)
 
-        state = DecoderState(state=decoder_init_states, memory=initial_memory)
+        state = DecoderState(state=decoder_init_states, memory=DecoderMemory(initial_memory))
 
         return state
 
@@ -162,25 +208,40 @@ class BertDecoder(DecoderBase):
         if isinstance(x, list):
             x = Observation.to_batched_input(x, memory_size=self.memory_size).to(self.device)
 
-        batch_size = x.read_ind.size(0)
-
         # collect y_tm1 as inputs to inner rnn cells
         # Memory: (batch_size, mem_size, mem_value_dim)
         # (batch_size, mem_value_dim)
-        input_mem_entry = state_tm1.memory[torch.arange(batch_size, device=self.device), x.read_ind]
-
-        # (batch_size, hidden_size)
-        inner_output_t, inner_state_t = self.rnn_cell(input_mem_entry, state_tm1.state)
-
-        # attention over context
-        ctx_t, alpha_t = self.attention_func(query=inner_output_t,
-                                             keys=context_encoding['question_encoding_att_linear'],
-                                             values=context_encoding['question_encoding'],
-                                             entry_masks=context_encoding['question_mask'])
-
-        # (batch_size, hidden_size)
-        att_t = torch.tanh(self.att_vec_linear(torch.cat([inner_output_t, ctx_t], 1)))  # E.q. (5)
-        # att_t = self.dropout(att_t)
+        input_mem_entry = state_tm1.memory.read(x.read_ind)
+
+        if self.use_scripted_step:
+            # the scripted step implements the dot-product attention only
+            assert self.attention_func == self.dot_prod_attention
+
+            att_t, inner_state_t = get_scripted_lstm_attention_step()(
+                input_mem_entry,
+                state_tm1.state,
+                self.rnn_cell.cell_weights,
+                self.rnn_cell.dropout.p,
+                self.rnn_cell.training,
+                self.rnn_cell.use_skip_connection,
+                context_encoding['question_encoding'],
+                context_encoding['question_encoding_att_linear'],
+                context_encoding['question_mask'],
+                self.att_vec_linear.weight
+            )
+        else:
+            # (batch_size, hidden_size)
+            inner_output_t, inner_state_t = self.rnn_cell(input_mem_entry, state_tm1.state)
+
+            # attention over context
+            ctx_t, alpha_t = self.attention_func(query=inner_output_t,
+                                                 keys=context_encoding['question_encoding_att_linear'],
+                                                 values=context_encoding['question_encoding'],
+                                                 entry_masks=context_encoding['question_mask'])
+
+            # (batch_size, hidden_size)
+            att_t = torch.tanh(self.att_vec_linear(torch.cat([inner_output_t, ctx_t], 1)))  # E.q. (5)
+            # att_t = self.dropout(att_t)
 
         # compute scores over valid memory entries
         # memory is organized by:
@@ -188,7 +249,7 @@ class BertDecoder(DecoderBase):
 
         # dot product attention
         # (batch_size, mem_size)
-        mem_logits = torch.matmul(state_tm1.memory, att_t.unsqueeze(-1)).squeeze(-1)
+        mem_logits = state_tm1.memory.score(att_t)
 
         # add output features to logits
         # (batch_size, mem_size)
@@ -205,8 +266,8 @@ class BertDecoder(DecoderBase):
         write_value = att_t * write_mask.unsqueeze(-1)
 
         # write to memory
-        memory_tm1 = state_tm1.memory
-        memory_t = memory_tm1.scatter_add(1, write_ind.view(-1, 1, 1).expand(-1, -1, memory_tm1.size(-1)), write_value.unsqueeze(1))
+        # in place if gradients are disabled, so `state_tm1` is no longer valid afterwards
+        memory_t = state_tm1.memory.write(write_ind, write_value)
 
         state_t = DecoderState(state=inner_state_t, memory=memory_t)
 
@@ -1,5 +1,7 @@
 import collections
+from typing import List, Optional, Tuple
 
+import torch
 from torch import nn as nn
 
 
@@ -61,6 +63,187 @@ class MultiLayerDropoutLSTMCell(nn.Module):
 
         return o_i, state
 
+    @property
+    def cell_weights(self) -> List[List[torch.Tensor]]:
+        """The input-hidden and hidden-hidden weights and biases of each layer"""
+        return [
+            [cell.weight_ih, cell.weight_hh, cell.bias_ih, cell.bias_hh]
+            for cell in self.cell_list
+        ]
+
+
+def multi_layer_lstm_cell(
+    x: torch.Tensor,
+    s_tm1: List[Tuple[torch.Tensor, torch.Tensor]],
+    cell_weights: List[List[torch.Tensor]],
+    dropout: float,
+    training: bool,
+    use_skip_connection: bool
+) -> Tuple[torch.Tensor, List[Tuple[torch.Tensor, torch.Tensor]]]:
+    """
+    Functional version of `MultiLayerDropoutLSTMCell.forward` with the weights
+    given by `MultiLayerDropoutLSTMCell.cell_weights`, which can be compiled by TorchScript.
+    """
+    o_i = x
+    state: List[Tuple[torch.Tensor, torch.Tensor]] = []
+    for i, weights in enumerate(cell_weights):
+        h_tm1, c_tm1 = s_tm1[i]
+        h_i, c_i = torch.lstm_cell(x, [h_tm1, c_tm1], weights[0], weights[1], weights[2], weights[3])
+
+        if i > 0 and use_skip_connection:
+            o_i = h_i + x
+        else:
+            o_i = h_i
+
+        o_i = torch.dropout(o_i, dropout, training)
+
+        state.append((h_i, c_i))
+
+        x = o_i
+
+    return o_i, state
+
+
+class DecoderMemory(object):
+    """
+    The memory of a batch of decoder states, stored in a buffer of shape
+    (buffer_row_num, memory_size, value_size), in which `rows` gives the buffer row
+    of each entry of the batch (`None` for the identity).
+
+    With gradients disabled, the variables written at each decoding step are added to
+    the buffer in place, which is then shared with the memory of the next state, so the
+    memory of the previous state is no longer valid. With gradients enabled, every write
+    allocates a new buffer, so that autograd can keep the history of the memory.
+
+    The class-level counters keep track of the buffers allocated for decoder memories.
+    """
+
+    allocation_num = 0
+    allocated_bytes = 0
+
+    def __init__(self, buffer: torch.Tensor, rows: Optional[List[int]] = None):
+        self.buffer = buffer
+        self.rows = rows
+        self._row_index = None
+
+        if rows is None:
+            DecoderMemory._count_allocation(buffer)
+
+    @staticmethod
+    def _count_allocation(buffer: torch.Tensor):
+        DecoderMemory.allocation_num += 1
+        DecoderMemory.allocated_bytes += buffer.numel() * buffer.element_size()
+
+    @staticmethod
+    def get_allocation_stats():
+        return {'allocation_num': DecoderMemory.allocation_num, 'allocated_bytes': DecoderMemory.allocated_bytes}
+
+    @staticmethod
+    def reset_allocation_stats():
+        DecoderMemory.allocation_num = 0
+        DecoderMemory.allocated_bytes = 0
+
+    def __len__(self):
+        return len(self.rows) if self.rows is not None else self.buffer.size(0)
+
+    @property
+    def row_index(self) -> torch.Tensor:
+        """The buffer row of each entry, as a tensor"""
+        if self._row_index is None:
+            if self.rows is None:
+                self._row_index = torch.arange(self.buffer.size(0), device=self.buffer.device)
+            else:
+                self._row_index = torch.tensor(self.rows, dtype=torch.long, device=self.buffer.device)
+
+        return self._row_index
+
+    def read(self, read_ind: torch.Tensor) -> torch.Tensor:
+        """Returns the (batch_size, value_size) entries at `read_ind`"""
+        return self.buffer[self.row_index, read_ind]
+
+    def score(self, query: torch.Tensor) -> torch.Tensor:
+        """Returns the (batch_size, memory_size) dot products of the memory entries with `query`"""
+        if self.rows is None:
+            return torch.matmul(self.buffer, query.unsqueeze(-1)).squeeze(-1)
+
+        # score all rows of the buffer instead of gathering the rows in use
+        buffer_query = query.new_zeros(self.buffer.size(0), query.size(-1))
+        buffer_query[self.row_index] = query
+
+        return torch.matmul(self.buffer, buffer_query.unsqueeze(-1)).squeeze(-1)[self.row_index]
+
+    def write(self, write_ind: torch.Tensor, write_value: torch.Tensor) -> 'DecoderMemory':
+        """Add `write_value` of shape (batch_size, value_size) to the entries at `write_ind`"""
+        if torch.is_grad_enabled():
+            buffer = self.buffer[self.row_index] if self.rows is not None else self.buffer
+            buffer = buffer.scatter_add(
+                1, write_ind.view(-1, 1, 1).expand(-1, -1, buffer.size(-1)), write_value.unsqueeze(1))
+
+            return DecoderMemory(buffer)
+
+        self.buffer.index_put_((self.row_index, write_ind), write_value, accumulate=True)
+
+        return self
+
+    def __getitem__(self, indices) -> 'DecoderMemory':
+        rows = self.row_index[indices] if self.rows is not None else indices
+
+        return DecoderMemory(self.buffer[rows])
+
+    def __setitem__(self, indices, value: 'DecoderMemory'):
+        rows = self.row_index[indices] if self.rows is not None else indices
+        value_buffer = value.buffer[value.row_index] if value.rows is not None else value.buffer
+
+        self.buffer[rows] = value_buffer
+
+    def branch(self, indices: List[int]) -> 'DecoderMemory':
+        """
+        Returns the memory of new entries extending the entries at `indices`, like the
+        hypotheses of the next step of beam search. With gradients disabled, the first
+        new entry of each entry takes over its buffer row, and only the other ones, which
+        branch out from it, get a copy of the row in an unused one (copy-on-branch). The
+        buffer is compacted when less than half of its rows are in use. This memory is no
+        longer valid afterwards.
+        """
+        buffer_row_num = self.buffer.size(0)
+        if torch.is_grad_enabled() or len(indices) < buffer_row_num / 2:
+            return self[indices]
+
+        entry_rows = self.rows if self.rows is not None else range(buffer_row_num)
+
+        new_rows = []
+        is_used_row = [False] * buffer_row_num
+        branch_positions = []
+        for position, index in enumerate(indices):
+            row = entry_rows[index]
+            if is_used_row[row]:
+                branch_positions.append(position)
+                new_rows.append(row)
+            else:
+                is_used_row[row] = True
+                new_rows.append(row)
+
+        if branch_positions:
+            free_rows = [row for row in range(buffer_row_num) if not is_used_row[row]]
+            if len(free_rows) < len(branch_positions):
+                extra_row_num = len(branch_positions) - len(free_rows)
+                self.buffer = torch.cat([
+                    self.buffer,
+                    self.buffer.new_empty((extra_row_num,) + self.buffer.shape[1:])
+                ], dim=0)
+                DecoderMemory._count_allocation(self.buffer)
+
+                free_rows.extend(range(buffer_row_num, buffer_row_num + extra_row_num))
+
+            branch_rows = free_rows[:len(branch_positions)]
+            parent_rows = [new_rows[position] for position in branch_positions]
+            self.buffer[branch_rows] = self.buffer[parent_rows]
+
+            for position, row in zip(branch_positions, branch_rows):
+                new_rows[position] = row
+
+        return DecoderMemory(self.buffer, rows=new_rows)
+
 
 class DecoderState(object):
     def __init__(self, state, memory):
@@ -71,4 +254,25 @@ class DecoderState(object):
         sliced_state = [(s[0][indices], s[1][indices]) for s in self.state]
         sliced_memory = self.memory[indices]
 
-        return DecoderState(sliced_state, sliced_memory)
\ No newline at end of file
+        return DecoderState(sliced_state, sliced_memory)
+
+    def __setitem__(self, indices, value: 'DecoderState'):
+        """Overwrite the entries at `indices` in place with the entries of `value`"""
+        for (h, c), (value_h, value_c) in zip(self.state, value.state):
+            h[indices] = value_h
+            c[indices] = value_c
+
+        self.memory[indices] = value.memory
+
+    def branch(self, indices: List[int]) -> 'DecoderState':
+        """
+        Returns the states of new entries extending the entries at `indices`,
+        using copy-on-branch for the memory if supported.
+        """
+        if not isinstance(self.memory, DecoderMemory):
+            return self[indices]
+
+        branched_state = [(s[0][indices], s[1][indices]) for s in self.state]
+        branched_memory = self.memory.branch(indices)
+
+        return DecoderState(branched_state, branched_memory)
@@ -1,4 +1,4 @@
-from typing import List, Dict
+from typing import List, Dict, Any
 
 import torch
 from torch import nn as nn
@@ -20,4 +20,106 @@ class EncoderBase(nn.Module):
 
 
 ContextEncoding = Dict[str, torch.Tensor]
-COLUMN_TYPES = ['string', 'date', 'number', 'num1', 'num2']
\ No newline at end of file
+COLUMN_TYPES = ['string', 'date', 'number', 'num1', 'num2']
+
+# entries of a context encoding indexed by example, other entries (e.g., `batch_size`)
+# are shared by the whole batch. All the entries of a nested dict are indexed by example.
+PER_EXAMPLE_CONTEXT_ENCODING_KEYS = (
+    'question_encoding', 'question_mask', 'question_encoding_att_linear',
+    'column_encoding', 'column_mask', 'canonical_column_encoding', 'canonical_column_mask',
+    'cls_encoding', 'constant_encoding', 'constant_mask', 'table_bert_encoding'
+)
+
+
+class ContextEncodingCache(object):
+    """
+    Cache of per-environment context encodings, keyed by environment name.
+
+    Encodings are only valid for the model weights they were computed with,
+    the owner of the cache is responsible for calling `clear()` when the
+    weights are updated, or when moving to a new batch of environments.
+    """
+
+    def __init__(self):
+        self.entries = dict()
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def __contains__(self, env_name: str):
+        return env_name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries = dict()
+
+    def add(self, env_names: List[str], context_encoding: ContextEncoding):
+        """Split a batched context encoding into entries of each environment."""
+        for idx, env_name in enumerate(env_names):
+            self.entries[env_name] = {
+                key: _slice_batch_entry(value, idx) if key in PER_EXAMPLE_CONTEXT_ENCODING_KEYS
+                else _BatchSharedValue(value)
+                for key, value in context_encoding.items()
+            }
+
+        self.miss_count += len(env_names)
+
+    def get(self, env_names: List[str], new_env_names: List[str] = ()) -> ContextEncoding:
+        """Collate the cached encodings of `env_names` into a batched context encoding.
+
+        new_env_names: the environments just added to the cache, which were already
+            counted as misses.
+        """
+        entries = [self.entries[env_name] for env_name in env_names]
+        self.hit_count += len(env_names) - len(new_env_names)
+
+        context_encoding = _collate_batch_entries(entries)
+        context_encoding['batch_size'] = len(env_names)
+
+        return context_encoding
+
+    def stat(self):
+        return {'size': len(self.entries), 'hit': self.hit_count, 'miss': self.miss_count}
+
+
+class _BatchSharedValue(object):
+    """Wraps a non-batched value (e.g., `batch_size`) stored in a cache entry."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _slice_batch_entry(val: Any, idx: int) -> Any:
+    if isinstance(val, dict):
+        return {key: _slice_batch_entry(v, idx) for key, v in val.items()}
+    else:
+        return val[idx]
+
+
+def _collate_batch_entries(entries: List[Any]) -> Any:
+    first_entry = entries[0]
+    if isinstance(first_entry, dict):
+        return {
+            key: _collate_batch_entries([entry[key] for entry in entries])
+            for key in first_entry
+        }
+    elif isinstance(first_entry, torch.Tensor):
+        return _stack_and_pad(entries)
+    elif isinstance(first_entry, _BatchSharedValue):
+        return first_entry.value
+    else:
+        return list(entries)
+
+
+def _stack_and_pad(tensors: List[torch.Tensor]) -> torch.Tensor:
+    """Stack tensors along a new batch dimension, zero-padding every other dimension."""
+    max_shape = [max(dim_sizes) for dim_sizes in zip(*[tensor.size() for tensor in tensors])]
+    if all(list(tensor.size()) == max_shape for tensor in tensors):
+        return torch.stack(tensors, dim=0)
+
+    batched_tensor = tensors[0].new_zeros([len(tensors)] + max_shape)
+    for idx, tensor in enumerate(tensors):
+        batched_tensor[(idx,) + tuple(slice(0, size) for size in tensor.size())] = tensor
+
+    return batched_tensor
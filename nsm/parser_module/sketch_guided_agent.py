@@ -56,7 +56,7 @@ class SketchGuidedAgent(PGAgent):
             sketches
         )
 
-        context_encoding = self.encoder.encode(contexts)
+        context_encoding = self.encode(contexts, env_names=[traj.environment_name for traj in trajectories])
 
         batched_observation_seq, tgt_actions_info = Trajectory.to_batched_sequence_tensors(
             trajectories, self.memory_size)
@@ -124,10 +124,10 @@ class SketchGuidedAgent(PGAgent):
 
     def sample(
         self, environments, sample_num, use_cache=False,
-        constraint_sketches: Dict = None,
+        constraint_sketches: Dict = None, return_info=False
     ):
         if sample_num == 0:
-            return []
+            return ([], dict()) if return_info else []
 
         if use_cache:
             # if already explored everything, then don't explore this environment anymore.
@@ -177,14 +177,14 @@ class SketchGuidedAgent(PGAgent):
             ])
 
         if not duplicated_envs:
-            return []
+            return ([], dict()) if return_info else []
 
         environments = duplicated_envs
         for env in environments:
             env.use_cache = use_cache
 
         env_context = [env.get_context() for env in environments]
-        context_encoding = self.encode(env_context)
+        context_encoding = self.encode(env_context, env_names=[env.name for env in environments])
         sketch_encoding = self.sketch_encoder(sketches)
 
         completed_envs = []
@@ -296,10 +296,14 @@ class SketchGuidedAgent(PGAgent):
                 # if self.log:
                 #     print(f"{' '.join(traj.human_readable_program)} (correct={traj.reward == 1.}, prob={prob})", file=self.log)
 
+        if return_info:
+            return samples, dict()
+
         return samples
 
     def new_beam_search(self, environments, beam_size, use_cache=False, return_list=False,
-                        constraint_sketches=None, strict_constraint_on_sketches=False, force_sketch_coverage=False):
+                        constraint_sketches=None, strict_constraint_on_sketches=False, force_sketch_coverage=False,
+                        max_decode_steps: int = None):
         # if already explored everything, then don't explore this environment anymore.
         if use_cache:
             # if already explored everything, then don't explore this environment anymore.
@@ -333,7 +337,7 @@ class SketchGuidedAgent(PGAgent):
 
         # (env_num, ...)
         env_context = [env.get_context() for env in environments]
-        context_encoding = self.encode(env_context)
+        context_encoding = self.encode(env_context, env_names=[env.name for env in environments])
 
         # List[List * env_num]
         nested_hyp_sketches = []
@@ -408,7 +412,9 @@ class SketchGuidedAgent(PGAgent):
             ], device=self.device
         )
 
+        t = 0
         while beams:
+            t += 1
             if self.log:
                 print(f't={state_tm1.t}', file=self.log)
 
@@ -585,6 +591,9 @@ class SketchGuidedAgent(PGAgent):
             if len(new_beams) == 0:
                 break
 
+            if max_decode_steps is not None and t >= max_decode_steps:
+                break
+
             if self.log:
                 _log_beam(new_beams)
 
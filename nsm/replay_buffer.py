@@ -39,7 +39,9 @@ class ReplayBuffer(object):
             if env.name in programs:
                 program_str_list = programs[env.name]
                 n += len(program_str_list)
-                env.cache._set = set(program_str_list)
+                env.cache.reset()
+                for program_str in program_str_list:
+                    env.cache.save(env.de_vocab.lookup(program_str.split()))
                 for program_str in program_str_list:
                     program = program_str.split()
                     try:
@@ -0,0 +1,119 @@
+from typing import List, Dict, FrozenSet
+
+import numpy as np
+
+from nsm.sketch.sketch import Sketch
+
+
+class SketchAutomaton(object):
+    """
+    The constraint sketches of an environment compiled into a deterministic automaton over
+    its action ids. A (partial) program reaches a state whose compatible sketches are exactly
+    the sketches `Sketch.is_compatible_with_program` accepts for it, and each state has a mask
+    over the memory of the actions that keep the program compatible with any sketch.
+
+    Each state follows a prefix of the sketches. An action whose sketch token does not continue
+    any of them leads to a tail state, which is only compatible with the sketches the prefix has
+    already covered, and the dead state is not compatible with any sketch.
+    """
+
+    DEAD_STATE = 0
+
+    def __init__(self, sketches: List[Sketch], de_vocab, memory_size: int):
+        self.sketches = list(sketches)
+        self.memory_size = memory_size
+
+        # sketch token of each action id
+        action_tokens = [
+            de_vocab.lookup(action_id, reverse=True) or ''
+            for action_id in range(min(memory_size, de_vocab.size))
+        ]
+        self.action_tokens = Sketch.program_to_sketch(action_tokens)
+
+        self.token_action_ids: Dict[str, List[int]] = dict()
+        for action_id, token in enumerate(self.action_tokens):
+            self.token_action_ids.setdefault(token, []).append(action_id)
+
+        self.state_transitions: List[Dict[str, int]] = []
+        self.state_fallbacks: List[int] = []
+        self.state_sketch_ids: List[FrozenSet[int]] = []
+        self._tail_states: Dict[FrozenSet[int], int] = dict()
+        self._state_masks: Dict[int, np.ndarray] = dict()
+
+        dead_state = self._add_state(frozenset())
+        self._tail_states[frozenset()] = dead_state
+
+        self.initial_state = self._add_prefix_state(frozenset(range(len(self.sketches))), frozenset(), 0)
+
+    def _add_state(self, sketch_ids: FrozenSet[int]) -> int:
+        state = len(self.state_transitions)
+        self.state_transitions.append(dict())
+        self.state_fallbacks.append(state)
+        self.state_sketch_ids.append(sketch_ids)
+
+        return state
+
+    def _add_prefix_state(self, passing_sketch_ids: FrozenSet[int], covered_sketch_ids: FrozenSet[int], depth: int) -> int:
+        """
+        Add the state of a prefix of length `depth` shared by the sketches `passing_sketch_ids`,
+        after the shorter sketches `covered_sketch_ids` have been covered.
+        """
+        state = self._add_state(passing_sketch_ids | covered_sketch_ids)
+
+        covered_sketch_ids = covered_sketch_ids | frozenset(
+            sketch_id for sketch_id in passing_sketch_ids if len(self.sketches[sketch_id]) == depth)
+
+        next_token_sketch_ids = dict()
+        for sketch_id in sorted(passing_sketch_ids):
+            if len(self.sketches[sketch_id]) > depth:
+                next_token_sketch_ids.setdefault(self.sketches[sketch_id][depth], []).append(sketch_id)
+
+        for token, sketch_ids in next_token_sketch_ids.items():
+            self.state_transitions[state][token] = self._add_prefix_state(
+                frozenset(sketch_ids), covered_sketch_ids, depth + 1)
+
+        self.state_fallbacks[state] = self._get_tail_state(covered_sketch_ids)
+
+        return state
+
+    def _get_tail_state(self, covered_sketch_ids: FrozenSet[int]) -> int:
+        if covered_sketch_ids not in self._tail_states:
+            self._tail_states[covered_sketch_ids] = self._add_state(covered_sketch_ids)
+
+        return self._tail_states[covered_sketch_ids]
+
+    def step(self, state: int, action_id: int) -> int:
+        token = self.action_tokens[action_id]
+
+        return self.state_transitions[state].get(token, self.state_fallbacks[state])
+
+    def get_state(self, action_ids: List[int]) -> int:
+        state = self.initial_state
+        for action_id in action_ids:
+            state = self.step(state, action_id)
+
+        return state
+
+    def is_dead(self, state: int) -> bool:
+        return state == self.DEAD_STATE
+
+    def get_compatible_sketches(self, state: int) -> List[Sketch]:
+        return [self.sketches[sketch_id] for sketch_id in sorted(self.state_sketch_ids[state])]
+
+    def get_allowed_action_mask(self, state: int) -> np.ndarray:
+        """Boolean mask of shape (memory_size,) of the actions that do not lead to the dead state"""
+        mask = self._state_masks.get(state)
+        if mask is None:
+            if self.is_dead(self.state_fallbacks[state]):
+                mask = np.zeros(self.memory_size, dtype=np.bool_)
+                for token in self.state_transitions[state]:
+                    mask[self.token_action_ids.get(token, [])] = True
+            else:
+                mask = np.ones(self.memory_size, dtype=np.bool_)
+
+            self._state_masks[state] = mask
+
+        return mask
+
+    def has_allowed_action(self, state: int, action_ids: List[int]) -> bool:
+        return bool(self.get_allowed_action_mask(state)[action_ids].any())
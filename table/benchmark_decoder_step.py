@@ -0,0 +1,140 @@
+"""Microbenchmark of `BertDecoder.step` on CPU, comparing the eager recurrent cells
+and attention against their TorchScript version (`use_scripted_decoder_step`),
+at the batch sizes of the actors (`batch_size` x `n_explore_samples`) and the
+evaluator (32 x `beam_size`).
+
+Usage:
+    python -m table.benchmark_decoder_step --config-file data/config/config.table_bert.json
+"""
+
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+
+from nsm.env_factory import Observation
+from nsm.execution.worlds.wikitablequestions import world_config as wikitablequestions_config
+from nsm.parser_module.bert_decoder import BertDecoder
+
+
+def build_decoder(config, bert_hidden_size: int, use_scripted_step: bool) -> BertDecoder:
+    # the decoder only needs the output sizes of the encoder
+    encoder = SimpleNamespace(
+        output_size=config['hidden_size'],
+        bert_model=SimpleNamespace(bert_config=SimpleNamespace(hidden_size=bert_hidden_size))
+    )
+
+    decoder = BertDecoder.build(dict(config, use_scripted_decoder_step=use_scripted_step), encoder)
+    decoder.eval()
+
+    return decoder
+
+
+def get_context_encoding(config, batch_size, question_length, bert_hidden_size, generator):
+    memory_size = config['memory_size']
+    constant_num = memory_size - config['builtin_func_num']
+    question_lengths = torch.randint(question_length // 2, question_length + 1, (batch_size,), generator=generator)
+
+    return {
+        'cls_encoding': torch.randn(batch_size, bert_hidden_size, generator=generator),
+        'constant_encoding': torch.randn(batch_size, constant_num, config['value_embedding_size'], generator=generator),
+        'question_encoding': torch.randn(batch_size, question_length, config['hidden_size'], generator=generator),
+        'question_encoding_att_linear': torch.randn(batch_size, question_length, config['hidden_size'],
+                                                    generator=generator),
+        'question_mask': (torch.arange(question_length).unsqueeze(0) < question_lengths.unsqueeze(1)).float()
+    }
+
+
+def get_observations(config, batch_size, n_steps, generator):
+    memory_size = config['memory_size']
+
+    observations = []
+    for t in range(n_steps):
+        read_ind = torch.randint(0, memory_size, (batch_size,), generator=generator)
+        write_ind = torch.randint(-1, memory_size, (batch_size,), generator=generator)
+        output_features = torch.rand(batch_size, memory_size, config['n_de_output_features'], generator=generator)
+        valid_action_mask = (torch.rand(batch_size, memory_size, generator=generator) < 0.5).float()
+        valid_action_mask[:, 0] = 1.
+
+        observations.append(Observation(read_ind, write_ind, None, output_features, valid_action_mask))
+
+    return observations
+
+
+def run_decoder(decoder, context_encoding, observations):
+    action_scores = []
+    state_tm1 = decoder.get_initial_state(context_encoding)
+    for observation in observations:
+        action_score_t, state_tm1 = decoder.step_and_get_action_scores_t(observation, state_tm1, context_encoding)
+        action_scores.append(action_score_t)
+
+    return action_scores
+
+
+def time_decoder(decoder, context_encoding, observations, n_warmup_steps):
+    run_decoder(decoder, context_encoding, observations[:n_warmup_steps])
+
+    t1 = time.perf_counter()
+    run_decoder(decoder, context_encoding, observations)
+    t2 = time.perf_counter()
+
+    return len(observations) / (t2 - t1)
+
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--config-file', type=Path, default=Path('data/config/config.table_bert.json'))
+    arg_parser.add_argument('--batch-sizes', type=int, nargs='+', default=None,
+                            help='defaults to the batch sizes of the actors and the evaluator')
+    arg_parser.add_argument('--bert-hidden-size', type=int, default=768)
+    arg_parser.add_argument('--question-length', type=int, default=40)
+    arg_parser.add_argument('--n-steps', type=int, default=200)
+    arg_parser.add_argument('--n-warmup-steps', type=int, default=20)
+    arg_parser.add_argument('--num-threads', type=int, default=None)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    config = json.load(args.config_file.open())
+    config['builtin_func_num'] = wikitablequestions_config['interpreter_builtin_func_num']
+
+    batch_sizes = args.batch_sizes or [
+        config['batch_size'],
+        config['batch_size'] * config['n_explore_samples'],
+        32 * config['beam_size']
+    ]
+
+    torch.manual_seed(args.seed)
+    eager_decoder = build_decoder(config, args.bert_hidden_size, use_scripted_step=False)
+    scripted_decoder = build_decoder(config, args.bert_hidden_size, use_scripted_step=True)
+    scripted_decoder.load_state_dict(eager_decoder.state_dict())
+
+    print(f'{"batch":>6} {"eager (steps/s)":>16} {"scripted (steps/s)":>19} {"speedup":>8} {"max diff":>10}')
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            generator = torch.Generator().manual_seed(args.seed)
+            context_encoding = get_context_encoding(config, batch_size, args.question_length,
+                                                    args.bert_hidden_size, generator)
+            observations = get_observations(config, batch_size, args.n_steps, generator)
+
+            eager_scores = run_decoder(eager_decoder, context_encoding, observations)
+            scripted_scores = run_decoder(scripted_decoder, context_encoding, observations)
+            max_diff = max(
+                (eager_score_t - scripted_score_t).abs().max().item()
+                for eager_score_t, scripted_score_t in zip(eager_scores, scripted_scores)
+            )
+
+            eager_speed = time_decoder(eager_decoder, context_encoding, observations, args.n_warmup_steps)
+            scripted_speed = time_decoder(scripted_decoder, context_encoding, observations, args.n_warmup_steps)
+
+            print(f'{batch_size:>6} {eager_speed:>16.1f} {scripted_speed:>19.1f} '
+                  f'{scripted_speed / eager_speed:>8.2f} {max_diff:>10.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Compare the fp32 encoder of a trained agent against its dynamically quantized
+int8 version (`quantize_encoder`) on CPU, reporting the encoding speed and the
+accuracy on the dev set of each.
+
+Usage:
+    python -m table.benchmark_encoder_quantization \
+        --model-file runs/demo_run/model.best.bin \
+        --dev-file data/wikitable/wtq_preprocess_0805_no_anonymize_ent/dev_split.jsonl
+"""
+
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import torch
+
+from nsm import nn_util
+from nsm.evaluator import Evaluation
+from nsm.parser_module.agent import PGAgent
+from table.experiments import load_environments
+
+
+def time_encode(agent, envs, batch_size):
+    t1 = time.perf_counter()
+    for batched_envs in nn_util.batch_iter(envs, batch_size):
+        agent.encode([env.context for env in batched_envs])
+    t2 = time.perf_counter()
+
+    return (t2 - t1) / len(envs)
+
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--model-file', type=Path, required=True)
+    arg_parser.add_argument('--dev-file', type=Path, required=True)
+    arg_parser.add_argument('--batch-size', type=int, default=32)
+    arg_parser.add_argument('--beam-size', type=int, default=None, help='defaults to `beam_size` in the config')
+    arg_parser.add_argument('--max-examples', type=int, default=None)
+    arg_parser.add_argument('--num-threads', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    agent = PGAgent.load(str(args.model_file), gpu_id=-1).eval()
+    config = agent.config
+    beam_size = args.beam_size or config['beam_size']
+
+    envs = load_environments([str(args.dev_file)],
+                             table_file=config['table_file'],
+                             table_representation_method=config['table_representation'],
+                             bert_tokenizer=agent.encoder.bert_model.tokenizer)
+    for env in envs:
+        env.use_cache = False
+        env.punish_extra_work = False
+    envs = envs[:args.max_examples]
+
+    results = dict()
+    with torch.no_grad():
+        for mode in ['fp32', 'int8']:
+            if mode == 'int8':
+                agent.quantize_encoder()
+
+            encode_time = time_encode(agent, envs, args.batch_size)
+            decode_results = agent.decode_examples(envs, beam_size=beam_size, batch_size=args.batch_size)
+            eval_results = Evaluation.evaluate_decode_results(envs, decode_results)
+
+            results[mode] = dict(encode_time=encode_time, **eval_results)
+
+    print(f'{"encoder":>8} {"encode (ms/example)":>20} {"accuracy":>9} {"oracle accuracy":>16}')
+    for mode, result in results.items():
+        print(f'{mode:>8} {result["encode_time"] * 1000:>20.2f} {result["accuracy"]:>9.4f} '
+              f'{result["oracle_accuracy"]:>16.4f}')
+
+    print(f'encode speedup {results["fp32"]["encode_time"] / results["int8"]["encode_time"]:.2f}, '
+          f'accuracy delta {results["int8"]["accuracy"] - results["fp32"]["accuracy"]:+.4f} '
+          f'on {len(envs)} dev examples')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Microbenchmark of `QAProgrammingEnv.clone`, comparing the structural-sharing
+clone against the previous implementation, which calls the constructor and
+copies the histories of the environment.
+
+Usage:
+    python -m table.benchmark_env_clone \
+        --example-file data/wikitable/wtq_preprocess_0805_no_anonymize_ent/data_split_1/train_split_shard_90-0.jsonl \
+        --table-file data/wikitable/wtq_preprocess_0805_no_anonymize_ent/tables.jsonl
+"""
+
+import random
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from pytorch_pretrained_bert import BertTokenizer
+
+from nsm.env_factory import QAProgrammingEnv
+from table.experiments import load_environments
+
+
+def clone_with_constructor(env: QAProgrammingEnv) -> QAProgrammingEnv:
+    """The previous implementation of `QAProgrammingEnv.clone`."""
+    new_interpreter = env.interpreter.clone()
+    new = QAProgrammingEnv(
+        question_annotation=env.question_annotation,
+        kg=env.kg,
+        answer=env.answer,
+        score_fn=env.score_fn,
+        interpreter=new_interpreter,
+        de_vocab=env.de_vocab,
+        constants=env.constants,
+        init_interp=False,
+        context=env.context,
+        id_feature_dict=env.id_feature_dict,
+        cache=env.cache,
+        reset=False,
+    )
+    new.actions = env.actions[:]
+    new.mapped_actions = env.mapped_actions[:]
+    new.program = env.program[:]
+    new.rewards = env.rewards[:]
+    new.obs = env.obs[:]
+    new.done = env.done
+    new.name = env.name
+    new.cache = env.cache
+    new.use_cache = env.use_cache
+    new.valid_actions = env.valid_actions
+    new.start_ob = env.start_ob
+    new.error = env.error
+    new.id_feature_dict = env.id_feature_dict
+    new.punish_extra_work = env.punish_extra_work
+    new.trigger_words_dict = env.trigger_words_dict
+
+    return new
+
+
+def get_partial_programs(envs, n_steps, rng):
+    """Environments in the middle of random programs of at most `n_steps` steps."""
+    partial_envs = []
+    for env in envs:
+        env = env.clone()
+        for _ in range(n_steps):
+            if env.done:
+                break
+            env.step(rng.randrange(len(env.valid_actions)))
+
+        partial_envs.append(env)
+
+    return partial_envs
+
+
+def time_clone(envs, clone_fn, n_clones):
+    t1 = time.perf_counter()
+    for env in envs:
+        for _ in range(n_clones):
+            clone_fn(env)
+    t2 = time.perf_counter()
+
+    return (t2 - t1) / (len(envs) * n_clones)
+
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--example-file', type=Path, required=True)
+    arg_parser.add_argument('--table-file', type=Path, required=True)
+    arg_parser.add_argument('--bert-model', type=str, default='bert-base-uncased')
+    arg_parser.add_argument('--max-examples', type=int, default=200)
+    arg_parser.add_argument('--n-clones', type=int, default=20, help='number of clones per environment')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    envs = load_environments([str(args.example_file)],
+                             table_file=str(args.table_file),
+                             bert_tokenizer=BertTokenizer.from_pretrained(args.bert_model))
+    envs = envs[:args.max_examples]
+
+    print(f'{"steps":>6} {"constructor (us)":>18} {"clone (us)":>12} {"speedup":>8}')
+    for n_steps in [0, 5, 10, 20]:
+        partial_envs = get_partial_programs(envs, n_steps, rng)
+
+        constructor_time = time_clone(partial_envs, clone_with_constructor, args.n_clones)
+        clone_time = time_clone(partial_envs, QAProgrammingEnv.clone, args.n_clones)
+
+        print(f'{n_steps:>6} {constructor_time * 1e6:>18.1f} {clone_time * 1e6:>12.1f} '
+              f'{constructor_time / clone_time:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Check that the vectorized table operations over the columnar store (and
+row sets) give identical results to the reference implementations over the
+python dictionaries.
+
+Usage:
+    python -m table.check_executor_equivalence --table-file data/wikitable/wtq_preprocess_0805_no_anonymize_ent/tables.jsonl
+"""
+
+import json
+import math
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from nsm.execution.worlds.wikitablequestions import WikiTableExecutor
+
+
+FILTER_OPS = ['filter_ge', 'filter_greater', 'filter_le', 'filter_less']
+AGGREGATION_OPS = ['maximum', 'minimum', 'sum', 'average', 'mode']
+SORT_OPS = ['argmax', 'argmin']
+ROW_OPS = ['next', 'previous', 'first', 'last', 'count']
+EQUALITY_OPS = ['filter_equal', 'filter_not_equal']
+STRING_OPS = ['filter_str_contain_any', 'filter_str_contain_not_any']
+
+
+def run_op(executor, op_name, args):
+    try:
+        return 'ok', getattr(executor, op_name)(*args)
+    except Exception as e:
+        return 'error', type(e).__name__
+
+
+def results_equal(result, other_result) -> bool:
+    """Compare the results of two operations, element-wise for lists, with NaN equal to NaN."""
+    if isinstance(result, float) and isinstance(other_result, float):
+        if math.isnan(result) or math.isnan(other_result):
+            return math.isnan(result) and math.isnan(other_result)
+
+        return math.isclose(result, other_result, rel_tol=1e-9, abs_tol=1e-12)
+    elif isinstance(result, (list, tuple)) and isinstance(other_result, (list, tuple)):
+        return (
+            len(result) == len(other_result) and
+            all(results_equal(val, other_val) for val, other_val in zip(result, other_result))
+        )
+
+    return result == other_result
+
+
+def get_test_cases(table, n_samples, rng):
+    row_ents = table['row_ents']
+    kg = table['kg']
+
+    for _ in range(n_samples):
+        if not row_ents:
+            break
+
+        ents = rng.sample(row_ents, rng.randint(1, len(row_ents)))
+        if rng.random() < 0.5:
+            # rows in table order can be represented as row sets
+            ents = sorted(ents, key=row_ents.index)
+        elif rng.random() < 0.2:
+            # duplicated entities are kept by some operations
+            ents = ents + ents[:1]
+
+        for op_name in ROW_OPS:
+            yield op_name, (ents, )
+
+        for prop in table['props']:
+            for op_name in AGGREGATION_OPS:
+                yield op_name, (ents, prop)
+
+            values = [val for ent in row_ents for val in kg.get(ent, {}).get(prop, [])]
+            if values:
+                query = rng.sample(values, min(len(values), rng.randint(1, 2)))
+                for op_name in EQUALITY_OPS:
+                    yield op_name, (ents, query, prop)
+                yield 'is_connected', (ents[:1], query[:1], prop)
+
+                if prop not in table['num_props'] and prop not in table['datetime_props']:
+                    # substrings of the cell values
+                    strings = []
+                    for val in rng.sample(values, min(len(values), 2)):
+                        start = rng.randint(0, len(val))
+                        strings.append(val[start:rng.randint(start, len(val))])
+                    for op_name in STRING_OPS:
+                        yield op_name, (ents, strings, prop)
+                    yield 'autocomplete_filter_str_contain_any', (
+                        [None, {'value': ents}, {'value': strings}], [prop], [{'value': prop}])
+
+            ents_with_same = ents[:1]
+            yield 'same', (ents_with_same, prop, {'all_rows': {'value': row_ents}})
+
+            if prop in table['num_props'] or prop in table['datetime_props']:
+                for op_name in SORT_OPS:
+                    yield op_name, (ents, prop)
+
+                if not values:
+                    continue
+
+                for op_name in FILTER_OPS:
+                    query = rng.sample(values, min(len(values), rng.randint(1, 2)))
+                    yield op_name, (ents, query, prop)
+
+
+def check_table(table, n_samples, rng):
+    reference_executor = WikiTableExecutor(table, use_columnar_store=False, use_row_sets=False)
+    columnar_executor = WikiTableExecutor(table, use_columnar_store=True)
+
+    n_checked = 0
+    mismatches = []
+    reference_time = columnar_time = 0.
+    for op_name, args in get_test_cases(table, n_samples, rng):
+        # entity lists in table order are passed to the columnar executor as row sets
+        if op_name == 'same':
+            columnar_args = args[:2] + ({'all_rows': {'value': columnar_executor.make_row_set(table['row_ents'])}}, )
+        elif op_name.startswith('autocomplete'):
+            columnar_args = args
+        else:
+            columnar_args = (columnar_executor.make_row_set(args[0]), ) + args[1:]
+
+        t1 = time.time()
+        reference_result = run_op(reference_executor, op_name, args)
+        t2 = time.time()
+        columnar_result = run_op(columnar_executor, op_name, columnar_args)
+        t3 = time.time()
+
+        reference_time += t2 - t1
+        columnar_time += t3 - t2
+        n_checked += 1
+
+        if not results_equal(reference_result, columnar_result):
+            mismatches.append((op_name, args, reference_result, columnar_result))
+
+    return n_checked, mismatches, reference_time, columnar_time
+
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--table-file', type=Path, required=True)
+    arg_parser.add_argument('--n-samples', type=int, default=5, help='number of random row subsets per table')
+    arg_parser.add_argument('--max-tables', type=int, default=None)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    n_tables = n_checked = 0
+    all_mismatches = []
+    reference_time = columnar_time = 0.
+    with args.table_file.open() as f:
+        for line in f:
+            table = json.loads(line)
+            table_n_checked, mismatches, table_reference_time, table_columnar_time = check_table(
+                table, args.n_samples, rng)
+
+            n_tables += 1
+            n_checked += table_n_checked
+            reference_time += table_reference_time
+            columnar_time += table_columnar_time
+            all_mismatches.extend((table['name'], ) + m for m in mismatches)
+
+            if args.max_tables and n_tables >= args.max_tables:
+                break
+
+    for table_name, op_name, op_args, reference_result, columnar_result in all_mismatches[:50]:
+        print(f'[{table_name}] {op_name}{op_args}: reference={reference_result}, columnar={columnar_result}',
+              file=sys.stderr)
+
+    print(f'{n_tables} tables, {n_checked} operations checked, {len(all_mismatches)} mismatches')
+    print(f'reference implementation took {reference_time:.2f}s, columnar store took {columnar_time:.2f}s')
+
+    if all_mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Check that the cache of explored programs (`SearchCache`) of an environment
+is full once all the programs of the environment are explored, when they are
+sampled with the cache by clones of the environment, as in `PGAgent.sample`.
+As the cache removes the explored actions, every rollout ends in a new program,
+and the cache must be full after exactly as many rollouts as there are programs.
+Environments are limited to a few expressions, so that all their programs can
+be enumerated.
+
+Usage:
+    python -m table.check_search_cache \
+        --example-file data/wikitable/wtq_preprocess_0805_no_anonymize_ent/data_split_1/train_split_shard_90-0.jsonl \
+        --table-file data/wikitable/wtq_preprocess_0805_no_anonymize_ent/tables.jsonl
+"""
+
+import random
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from nsm.data_utils import load_jsonl
+from table.experiments import create_environments
+
+
+def count_programs(env, max_programs):
+    """Count the programs of an environment by enumerating them without the cache,
+    returns None if there are more than `max_programs`."""
+    n_programs = 0
+    stack = [env.clone()]
+    while stack:
+        env = stack.pop()
+        if env.done:
+            n_programs += 1
+            if n_programs > max_programs:
+                return None
+
+            continue
+
+        for action in range(len(env.valid_actions)):
+            new_env = env.clone()
+            new_env.step(action)
+            stack.append(new_env)
+
+    return n_programs
+
+
+def explore_with_cache(env, max_rollouts, rng):
+    """Sample programs with the cache until it is full, returns the number of rollouts."""
+    env.use_cache = True
+    n_rollouts = 0
+    while not env.cache.is_full() and n_rollouts < max_rollouts:
+        new_env = env.clone()
+        while not new_env.done:
+            new_env.step(rng.randrange(len(new_env.valid_actions)))
+
+        n_rollouts += 1
+
+    return n_rollouts
+
+
+def main():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--example-file', type=Path, required=True)
+    arg_parser.add_argument('--table-file', type=Path, required=True)
+    arg_parser.add_argument('--max-examples', type=int, default=100)
+    arg_parser.add_argument('--max-n-exp', type=int, default=1, help='maximum number of expressions of a program')
+    arg_parser.add_argument('--max-programs', type=int, default=1000,
+                            help='environments with more programs are skipped')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    dataset = load_jsonl(str(args.example_file))[:args.max_examples]
+    table_dict = {table['name']: table for table in load_jsonl(str(args.table_file))}
+    envs = create_environments(table_dict, dataset,
+                               table_representation_method='canonical',
+                               executor_type='wtq',
+                               max_n_exp=args.max_n_exp)
+
+    n_checked = 0
+    failures = []
+    for env in envs:
+        n_programs = count_programs(env, args.max_programs)
+        if n_programs is None:
+            continue
+
+        n_rollouts = explore_with_cache(env, n_programs * 2, rng)
+        n_checked += 1
+
+        if not env.cache.is_full() or n_rollouts != n_programs:
+            failures.append((env.name, n_programs, n_rollouts, env.cache.is_full()))
+
+    for env_name, n_programs, n_rollouts, is_full in failures[:50]:
+        print(f'[{env_name}] {n_programs} programs, {n_rollouts} rollouts, is_full={is_full}', file=sys.stderr)
+
+    print(f'{n_checked} environments checked, {len(failures)} failures')
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
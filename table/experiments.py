@@ -241,7 +241,8 @@ def load_environments(
     table_file: str,
     table_representation_method: str = 'canonical',
     example_ids: Iterable = None,
-    bert_tokenizer: BertTokenizer = None
+    bert_tokenizer: BertTokenizer = None,
+    use_columnar_store: bool = False
 ):
     dataset = []
     if example_ids is not None:
@@ -268,6 +269,7 @@ def load_environments(
         executor_type='wtq',
         max_n_mem=100, max_n_exp=10, #debug
         bert_tokenizer=bert_tokenizer,
+        use_columnar_store=use_columnar_store
     )
     print('{} environments in total'.format(len(environments)))
 
@@ -306,9 +308,12 @@ def create_environments(
     table_representation_method,
     executor_type,
     max_n_mem=60, max_n_exp=3,
-    bert_tokenizer=None
+    bert_tokenizer=None,
+    use_columnar_store=False
 ) -> List[QAProgrammingEnv]:
     all_envs = []
+    # templates of the tables, shared by all the environments over the same table
+    templates: Dict[str, TableEnvironmentTemplate] = dict()
 
     for i, example in enumerate(dataset):
         if i % 100 == 0:
@@ -316,73 +321,143 @@ def create_environments(
 
         kg_info = table_dict[example['context']]
 
+        template = templates.get(example['context'])
+        if template is None:
+            template = templates[example['context']] = TableEnvironmentTemplate(
+                kg_info, executor_type,
+                max_n_mem=max_n_mem, max_n_exp=max_n_exp,
+                use_columnar_store=use_columnar_store)
+
         env = create_environment(
             example, kg_info,
             table_representation_method,
             executor_type,
             max_n_mem, max_n_exp,
-            bert_tokenizer
+            bert_tokenizer,
+            template=template
         )
 
         all_envs.append(env)
 
+    print('{} table templates in total'.format(len(templates)))
+
     return all_envs
 
 
+class TableEnvironmentTemplate(object):
+    """The executor and the interpreter with built-in functions and table
+    constants of a table, built once and shared by all the environments
+    over the same table."""
+
+    def __init__(
+        self, table_kg: Dict,
+        executor_type: str = 'wtq',
+        max_n_mem: int = 60, max_n_exp: int = 3,
+        use_columnar_store: bool = False
+    ):
+        """
+        use_columnar_store: run the table operations of the WikiTableQuestions
+            executor over a columnar store of the table.
+        """
+        executor_kwargs = dict()
+        if executor_type == 'wtq':
+            self.score_fn = utils.wtq_score
+            self.process_answer_fn = lambda x: x
+            executor_fn = nsm.execution.worlds.wikitablequestions.WikiTableExecutor
+            executor_kwargs['use_columnar_store'] = use_columnar_store
+        elif executor_type == 'wikisql':
+            self.score_fn = utils.wikisql_score
+            self.process_answer_fn = utils.wikisql_process_answer
+            executor_fn = nsm.execution.worlds.wikisql.WikiSQLExecutor
+        else:
+            raise ValueError('Unknown executor {}'.format(executor_type))
+
+        self.executor = executor_fn(table_kg, **executor_kwargs)
+        api = self.executor.get_api()
+        self.type_hierarchy = api['type_hierarchy']
+        self.func_dict = api['func_dict']
+        self.constant_dict = api['constant_dict']
+
+        interpreter = LispInterpreter(
+            type_hierarchy=self.type_hierarchy,
+            max_mem=max_n_mem,
+            max_n_exp=max_n_exp,
+            assisted=True
+        )
+
+        for v in self.func_dict.values():
+            interpreter.add_function(**v)
+
+        interpreter.add_constant(
+            value=self.executor.make_row_set(table_kg['row_ents']),
+            type='entity_list',
+            name='all_rows')
+
+        # The vocabulary has a fixed number of memory slots, so it
+        # is built before adding the constants stored in memory.
+        self.de_vocab = interpreter.get_vocab()
+
+        prop_names = []
+        for c in self.constant_dict.values():
+            prop_names.append(interpreter.add_constant(value=c['value'], type=c['type']))
+
+        # functions and table constants are shared by all environments of the table
+        interpreter.namespace.freeze()
+        self.interpreter = interpreter
+
+        self.prop_ids = [
+            (self.de_vocab.lookup(name), interpreter.namespace[name]['value'])
+            for name in prop_names
+            if name in self.de_vocab.vocab and isinstance(interpreter.namespace[name]['value'], str)
+        ]
+
+    @property
+    def type_ancestry(self):
+        return self.interpreter.type_ancestry
+
+    @property
+    def namespace(self):
+        return self.interpreter.namespace
+
+    def create_environment(self, example: Dict, table_kg: Dict) -> QAProgrammingEnv:
+        """Create the environment of an example by adding its question entities to a clone of the interpreter."""
+        env = QAProgrammingEnv(
+            question_annotation=example,
+            kg=table_kg,
+            answer=self.process_answer_fn(example['answer']),
+            constants=self.constant_dict.values(),
+            interpreter=self.interpreter.clone(),
+            de_vocab=self.de_vocab,
+            score_fn=self.score_fn,
+            constants_initialized=True,
+            prop_ids=self.prop_ids,
+            name=example['id']
+        )
+
+        return env
+
+
 def create_environment(
         example_dict: Dict, table_kg: Dict,
         table_representation_method: str,
         executor_type: str = 'wtq',
         max_n_mem: int = 60, max_n_exp: int = 3,
         bert_tokenizer: BertTokenizer = None,
+        template: TableEnvironmentTemplate = None
 ) -> QAProgrammingEnv:
-    if executor_type == 'wtq':
-        score_fn = utils.wtq_score
-        process_answer_fn = lambda x: x
-        executor_fn = nsm.execution.worlds.wikitablequestions.WikiTableExecutor
-    elif executor_type == 'wikisql':
-        score_fn = utils.wikisql_score
-        process_answer_fn = utils.wikisql_process_answer
-        executor_fn = nsm.execution.worlds.wikisql.WikiSQLExecutor
-    else:
-        raise ValueError('Unknown executor {}'.format(executor_type))
-
-    executor = executor_fn(table_kg)
-    api = executor.get_api()
-    type_hierarchy = api['type_hierarchy']
-    func_dict = api['func_dict']
-    constant_dict = api['constant_dict']
-
-    interpreter = LispInterpreter(
-        type_hierarchy=type_hierarchy,
-        max_mem=max_n_mem,
-        max_n_exp=max_n_exp,
-        assisted=True
-    )
-
-    for v in func_dict.values():
-        interpreter.add_function(**v)
-
-    interpreter.add_constant(
-        value=table_kg['row_ents'],
-        type='entity_list',
-        name='all_rows')
+    if template is None:
+        template = TableEnvironmentTemplate(
+            table_kg, executor_type,
+            max_n_mem=max_n_mem, max_n_exp=max_n_exp)
 
+    example = example_dict
     if bert_tokenizer:
         example = annotate_example_for_bert(
             example_dict, table_kg, bert_tokenizer,
             table_representation_method=table_representation_method
         )
 
-    env = QAProgrammingEnv(
-        question_annotation=example,
-        kg=table_kg,
-        answer=process_answer_fn(example['answer']),
-        constants=constant_dict.values(),
-        interpreter=interpreter,
-        score_fn=score_fn,
-        name=example['id']
-    )
+    env = template.create_environment(example, table_kg)
 
     return env
 
@@ -414,13 +489,8 @@ def load_program_cache(cache_dir: Path) -> Dict:
 def to_human_readable_program(program, env):
     env = env.clone()
     env.use_cache = False
-    ob = env.start_ob
-
-    for tk in program:
-        valid_actions = list(ob.valid_action_indices)
-        action_id = env.de_vocab.lookup(tk)
-        rel_action_id = valid_actions.index(action_id)
-        ob, _, _, _ = env.step(rel_action_id)
+    # only the namespace after execution is needed to render the program
+    env.execute_program(program)
 
     readable_program = []
     first_intermediate_var_id = len(
@@ -109,7 +109,7 @@ def run_random_exploration(shard_id):
             interpreter.add_function(**v)
 
         interpreter.add_constant(
-            value=kg_info['row_ents'], type='entity_list', name='all_rows')
+            value=executor.make_row_set(kg_info['row_ents']), type='entity_list', name='all_rows')
 
         de_vocab = interpreter.get_vocab()
         env = env_factory.QAProgrammingEnv(
@@ -119,7 +119,6 @@ def run_random_exploration(shard_id):
             interpreter=interpreter,
             constant_value_embedding_fn=lambda x: None,
             score_fn=score_fn,
-            max_cache_size=args.n_explore_samples * args.n_epoch * 10,
             name=example['id'])
         all_envs.append(env)
 